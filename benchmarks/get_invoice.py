@@ -0,0 +1,149 @@
+"""
+Latency benchmark for GET /invoice/{id}: cold, warm and conditional (304) requests.
+
+Creates one invoice with many line items and payments, then times requests through the
+ASGI app:
+
+- cold: the serialized payload is not cached, so the invoice graph is loaded and
+  serialized;
+- warm: the payload is cached, so only the invoice row is read to check its version;
+- 304: the client sends the current ETag in If-None-Match.
+
+Needs DATABASE_URL pointing at a database with the schema pushed.
+
+    python -m benchmarks.get_invoice --line-items 200 --payments 20 --repeat 200
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, List
+
+import httpx
+import prisma
+import prisma.models
+import project.database
+import project.get_invoice_service
+import project.server
+
+
+async def create_invoice(line_items: int, payments: int) -> str:
+    user = await prisma.models.User.prisma().create(
+        data={"email": f"benchmark-{uuid.uuid4()}@example.com", "password": "hashed"}
+    )
+    service = await prisma.models.Service.prisma().create(
+        data={"name": "Software Development", "description": "Backend work"}
+    )
+    rate = await prisma.models.Rate.prisma().create(
+        data={"serviceId": service.id, "amount": 120.0, "currency": "USD"}
+    )
+    invoice = await prisma.models.Invoice.prisma().create(
+        data={
+            "userId": user.id,
+            "totalAmount": 120.0 * line_items,
+            "subtotal": 120.0 * line_items,
+            "totalTax": 0.0,
+            "taxBreakdown": prisma.Json([]),
+            "currency": "USD",
+            "status": "SENT",
+            "BillableItems": {
+                "create": [
+                    {
+                        "serviceId": service.id,
+                        "rateId": rate.id,
+                        "description": f"Software Development, sprint {number}",
+                        "quantity": 1.0,
+                        "unitPrice": 120.0,
+                        "amount": 120.0,
+                    }
+                    for number in range(line_items)
+                ]
+            },
+        }
+    )
+    await prisma.models.Payment.prisma().create_many(
+        data=[
+            {
+                "invoiceId": invoice.id,
+                "amount": 1.0,
+                "currency": "USD",
+                "paymentDate": datetime.now(timezone.utc),
+                "paymentMethod": "card",
+                "transactionId": str(uuid.uuid4()),
+            }
+            for _ in range(payments)
+        ]
+    )
+    # Bump the version after the payments, as the application does.
+    await prisma.models.Invoice.prisma().update(
+        where={"id": invoice.id}, data={"status": "SENT"}
+    )
+    return invoice.id
+
+
+async def measure(
+    client: httpx.AsyncClient,
+    url: str,
+    repeat: int,
+    expected_status: int,
+    headers: Dict[str, str],
+    cold: bool = False,
+) -> List[float]:
+    timings = []
+    for _ in range(repeat):
+        if cold:
+            project.get_invoice_service._cache.clear()
+        started = time.perf_counter()
+        response = await client.get(url, headers=headers)
+        timings.append((time.perf_counter() - started) * 1000)
+        assert response.status_code == expected_status, response.status_code
+    return sorted(timings)
+
+
+async def run(line_items: int, payments: int, repeat: int) -> None:
+    await project.database.connect()
+    try:
+        invoice_id = await create_invoice(line_items, payments)
+        url = f"/invoice/{invoice_id}"
+        transport = httpx.ASGITransport(app=project.server.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://benchmark"
+        ) as client:
+            response = await client.get(url)
+            etag = response.headers["ETag"]
+            print(
+                f"invoice with {line_items} line items and {payments} payments, "
+                f"{len(response.content)} byte payload"
+            )
+            print(f"{'request':<8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+            for label, timings in (
+                ("cold", await measure(client, url, repeat, 200, {}, cold=True)),
+                ("warm", await measure(client, url, repeat, 200, {})),
+                (
+                    "304",
+                    await measure(client, url, repeat, 304, {"If-None-Match": etag}),
+                ),
+            ):
+                p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+                print(
+                    f"{label:<8} {statistics.median(timings):>8.2f} "
+                    f"{p95:>8.2f} {timings[-1]:>8.2f}"
+                )
+    finally:
+        await project.database.disconnect()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--line-items", type=int, default=200)
+    parser.add_argument("--payments", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(run(args.line_items, args.payments, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
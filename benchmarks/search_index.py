@@ -0,0 +1,162 @@
+"""
+Memory and latency benchmark for the in-memory invoice search index.
+
+Builds an index of synthetic invoices (1M by default) spread over customers with
+realistic names, companies, tax ids and line items, then reports the memory the index
+holds, query latency percentiles for common query shapes and the longest the event loop
+went without running other tasks during a query. No database is needed.
+
+    python -m benchmarks.search_index --invoices 1000000 --users 50000
+
+The index has to fit next to the app in a 512M container, so keep an eye on the
+"index memory" line when changing the index layout.
+"""
+
+import argparse
+import asyncio
+import random
+import resource
+import statistics
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, List, Tuple
+
+from project.search_invoices_service import InvoiceSearchIndex, QueryTooBroadError
+
+FIRST_NAMES = [
+    "James", "Mary", "Robert", "Patricia", "John", "Jennifer", "Michael", "Linda",
+    "David", "Elizabeth", "William", "Barbara", "Richard", "Susan", "Joseph", "Jessica",
+    "Thomas", "Sarah", "Charles", "Karen", "Daniel", "Nancy", "Matthew", "Lisa",
+]  # fmt: skip
+
+LAST_NAMES = [
+    "Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis",
+    "Rodriguez", "Martinez", "Hernandez", "Lopez", "Gonzalez", "Wilson", "Anderson",
+    "Thomas", "Taylor", "Moore", "Jackson", "Martin", "Lee", "Perez", "Thompson",
+]  # fmt: skip
+
+COMPANY_WORDS = [
+    "Acme", "Globex", "Initech", "Umbrella", "Stark", "Wayne", "Wonka", "Hooli",
+    "Vandelay", "Soylent", "Tyrell", "Cyberdyne", "Aperture", "Massive", "Dynamic",
+    "Pied", "Piper", "Gringotts", "Oscorp", "Monarch", "Virtucon", "Nakatomi",
+]  # fmt: skip
+
+COMPANY_SUFFIXES = ["Inc", "LLC", "Corp", "Ltd", "GmbH", "Holdings", "Group"]
+
+LINE_ITEMS = [
+    "Project Management", "Software Development", "Quality Assurance",
+    "User Interface Design", "Database Migration", "Security Audit", "Hosting",
+    "Consulting", "Copper Pipe 15mm", "Steel Bracket", "Hard Drive 2TB",
+    "Network Switch 24 port", "Ethernet Cable Cat6", "Power Supply 750W",
+    "Graphics Card", "Laptop Stand", "Monitor 27 inch", "Keyboard", "Mouse",
+    "On-site Support", "Emergency Callout", "Training Session", "Licence Renewal",
+]  # fmt: skip
+
+
+def build(invoices: int, users: int, seed: int) -> InvoiceSearchIndex:
+    rng = random.Random(seed)
+    index = InvoiceSearchIndex()
+    for user in range(users):
+        index.index_profile(
+            f"user-{user}",
+            rng.choice(FIRST_NAMES),
+            rng.choice(LAST_NAMES),
+            f"{rng.choice(COMPANY_WORDS)} {rng.choice(COMPANY_WORDS)} "
+            f"{rng.choice(COMPANY_SUFFIXES)}",
+            f"{rng.randrange(10, 99)}-{rng.randrange(1000000, 9999999)}",
+        )
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    for invoice in range(invoices):
+        index.index_invoice(
+            f"{invoice:08x}-0000-4000-8000-000000000000",
+            f"user-{rng.randrange(users)}",
+            start + timedelta(minutes=invoice),
+            rng.sample(LINE_ITEMS, rng.randint(1, 4)),
+        )
+    return index
+
+
+async def measure(
+    search: Callable[[], Awaitable[object]], repeat: int
+) -> Tuple[List[float], float]:
+    """
+    Returns the sorted query timings and the longest gap, in milliseconds, between two
+    runs of a task sharing the event loop with the queries.
+    """
+    longest_stall = 0.0
+    last_tick = time.perf_counter()
+
+    async def tick() -> None:
+        nonlocal longest_stall, last_tick
+        while True:
+            now = time.perf_counter()
+            longest_stall = max(longest_stall, now - last_tick)
+            last_tick = now
+            await asyncio.sleep(0)
+
+    ticker = asyncio.create_task(tick())
+    await asyncio.sleep(0)
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await search()
+        timings.append((time.perf_counter() - started) * 1000)
+    ticker.cancel()
+    return sorted(timings), longest_stall * 1000
+
+
+async def run_queries(index: InvoiceSearchIndex, repeat: int) -> None:
+    queries = {
+        "two companies": "vandelay tyrell",
+        "customer + item": "smith hosting",
+        "common term": "development",
+        "prefix": "acme sec",
+        "short prefix": "g",
+        "tax id": "42",
+        "no match": "zzzz",
+    }
+    print(
+        f"{'query':<16} {'matches':>8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} "
+        f"{'stall ms':>9}"
+    )
+    for label, query in queries.items():
+        try:
+            total, _ = await index.search(query)
+        except QueryTooBroadError:
+            print(f"{label:<16} {'refused':>8}")
+            continue
+        timings, stall = await measure(lambda: index.search(query), repeat)
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        print(
+            f"{label:<16} {total:>8} {statistics.median(timings):>8.2f} "
+            f"{p95:>8.2f} {timings[-1]:>8.2f} {stall:>9.2f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--invoices", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    index = build(args.invoices, args.users, args.seed)
+    build_seconds = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"indexed {len(index)} invoices in {build_seconds:.1f}s")
+    print(f"index memory {current / 2**20:.0f} MiB (peak {peak / 2**20:.0f} MiB)")
+    # ru_maxrss is in KiB on Linux; it includes the interpreter and tracemalloc's own
+    # bookkeeping, so it overstates what the app needs.
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"process max RSS {max_rss / 2**10:.0f} MiB")
+
+    asyncio.run(run_queries(index, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
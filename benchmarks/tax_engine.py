@@ -0,0 +1,89 @@
+"""
+Latency benchmark for taxing large mixed invoices with the in-memory tax table.
+
+Builds a tax table with many jurisdictions, each with stacked SERVICE, GOODS and BOTH
+rates plus standalone rates, then times `compute_taxes` on invoices that mix service and
+part lines. No database is needed.
+
+    python -m benchmarks.tax_engine --jurisdictions 5000 --lines 10 1000 100000
+"""
+
+import argparse
+import random
+import statistics
+import time
+from typing import List, Tuple
+
+import prisma.enums
+import prisma.models
+from project.tax_engine import GOODS, SERVICE, TaxTable, compute_taxes
+
+BOTH = prisma.enums.TaxApplicableTo.BOTH
+
+
+def build_rates(jurisdictions: int) -> List[prisma.models.TaxRate]:
+    rates = []
+    for number in range(jurisdictions):
+        for kind, percentage in ((BOTH, 6.0), (SERVICE, 1.5), (GOODS, 2.25)):
+            rates.append(
+                prisma.models.TaxRate(
+                    id=f"rate-{number}-{kind}",
+                    name=f"{kind} tax {number}",
+                    percentage=percentage,
+                    applicableTo=kind,
+                    jurisdiction=f"J{number}",
+                )
+            )
+        rates.append(
+            prisma.models.TaxRate(
+                id=f"rate-{number}-standalone",
+                name=f"Standalone tax {number}",
+                percentage=7.5,
+                applicableTo=BOTH,
+                jurisdiction=None,
+            )
+        )
+    return rates
+
+
+def build_lines(count: int, rng: random.Random) -> List[Tuple[str, float]]:
+    return [
+        (SERVICE if rng.random() < 0.5 else GOODS, round(rng.uniform(1, 5000), 2))
+        for _ in range(count)
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--jurisdictions", type=int, default=5000)
+    parser.add_argument("--lines", type=int, nargs="+", default=[10, 1000, 100_000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    rates = build_rates(args.jurisdictions)
+    started = time.perf_counter()
+    table = TaxTable(rates)
+    print(
+        f"built table of {len(rates)} rates in "
+        f"{(time.perf_counter() - started) * 1000:.1f} ms"
+    )
+
+    print(f"{'lines':>8} {'p50 ms':>9} {'p95 ms':>9} {'ns/line':>9}")
+    for count in args.lines:
+        lines = build_lines(count, rng)
+        timings = []
+        for _ in range(args.repeat):
+            rate = rng.choice(rates)
+            started = time.perf_counter()
+            compute_taxes(table, table.jurisdiction_of(rate.id), lines)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        p50 = statistics.median(timings)
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        print(f"{count:>8} {p50:>9.3f} {p95:>9.3f} {p50 * 1e6 / count:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
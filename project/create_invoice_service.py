@@ -1,10 +1,25 @@
 import datetime
+import os
 from typing import List
 
 import prisma
 import prisma.models
+import project.database
+import project.invoice_number_service
+import project.search_invoices_service
+import project.tax_engine
 from pydantic import BaseModel
 
+# Currency of invoices that only bill parts; parts carry no currency of their own.
+DEFAULT_CURRENCY = os.getenv("DEFAULT_CURRENCY", "USD")
+
+
+class InvalidInvoiceError(ValueError):
+    """
+    # Currency of invoices that only bill parts, which have no currency of their own.
+        in more than one currency.
+    """
+
 
 class ServiceDetail(BaseModel):
     """
@@ -32,8 +47,12 @@ class CreateInvoiceOutput(BaseModel):
     """
 
     invoiceId: str
+    invoiceNumber: str
     status: str
+    subtotal: float
+    totalTax: float
     totalAmount: float
+    taxBreakdown: List[project.tax_engine.TaxBreakdownItem]
 
 
 async def create_invoice(
@@ -50,64 +69,116 @@ async def create_invoice(
     userId (str): The user ID of the invoice issuer.
     services (List[ServiceDetail]): List of services provided.
     parts (List[PartDetail]): List of parts used.
-    taxRateId (str): Identifier for the applicable tax rate based on jurisdiction.
+    taxRateId (str): Identifier of the tax rate charged on the invoice. It is charged on every line it applies to (SERVICE, GOODS or BOTH), together with any rates that share its jurisdiction.
     dueDate (str): Due date for the invoice payment.
 
     Returns:
     CreateInvoiceOutput: Output model for a newly created invoice, including all details for confirmation.
+
+    Raises:
+    InvalidInvoiceError: If a rate or part does not exist, or the services' rates are in different currencies.
     """
+    line_items = []
+    taxable_lines = []
+    billable_items = []
+    currencies = set()
     total_service_cost = 0
     for service in services:
         rate = await prisma.models.Rate.prisma().find_unique(
-            where={"id": service.rateId}
+            where={"id": service.rateId}, include={"Service": True}
         )
-        if rate:
-            total_service_cost += rate.amount * service.hours
+        if rate is None:
+            raise InvalidInvoiceError(f"Rate not found: {service.rateId}")
+        currencies.add(rate.currency)
+        total_service_cost += rate.amount * service.hours
+        taxable_lines.append((project.tax_engine.SERVICE, rate.amount * service.hours))
+        description = project.search_invoices_service.line_item_text(rate.Service, None)
+        line_items.append(description)
+        billable_items.append(
+            {
+                "serviceId": service.serviceId,
+                "rateId": service.rateId,
+                "description": description,
+                "quantity": service.hours,
+                "unitPrice": rate.amount,
+                "amount": rate.amount * service.hours,
+            }
+        )
+    if len(currencies) > 1:
+        names = ", ".join(sorted(currencies))
+        raise InvalidInvoiceError(
+            f"Services are billed in different currencies: {names}"
+        )
+    currency = currencies.pop() if currencies else DEFAULT_CURRENCY
     total_parts_cost = 0
     for part in parts:
         part_details = await prisma.models.Part.prisma().find_unique(
             where={"id": part.partId}
         )
-        if part_details:
-            total_parts_cost += (
-                part_details.cost
-                + part_details.cost * part_details.markupPercentage / 100
-            ) * part.quantity
-    tax_rate = await prisma.models.TaxRate.prisma().find_unique(where={"id": taxRateId})
-    if tax_rate:
-        total_tax = (total_service_cost + total_parts_cost) * (
-            tax_rate.percentage / 100
+        if part_details is None:
+            raise InvalidInvoiceError(f"Part not found: {part.partId}")
+        description = project.search_invoices_service.line_item_text(None, part_details)
+        line_items.append(description)
+        unit_price = (
+            part_details.cost + part_details.cost * part_details.markupPercentage / 100
         )
-    else:
-        total_tax = 0
-    total_amount_due = total_service_cost + total_parts_cost + total_tax
-    invoice = await prisma.models.Invoice.prisma().create(
-        data={
-            "userId": userId,
-            "dueDate": datetime.datetime.strptime(dueDate, "%Y-%m-%d"),
-            "totalAmount": total_amount_due,
-            "taxRateId": taxRateId,
-            "status": "DRAFT",
-        }
-    )
-    for service in services:
-        await prisma.models.BillableItem.prisma().create(
-            data={
-                "invoiceId": invoice.id,
-                "serviceId": service.serviceId,
-                "rateId": service.rateId,
-                "partId": "",
+        part_cost = unit_price * part.quantity
+        total_parts_cost += part_cost
+        taxable_lines.append((project.tax_engine.GOODS, part_cost))
+        billable_items.append(
+            {
+                "partId": part.partId,
+                "description": description,
+                "quantity": part.quantity,
+                "unitPrice": unit_price,
+                "amount": part_cost,
             }
         )
-    for part in parts:
-        await prisma.models.BillableItem.prisma().create(
+    tax_table, jurisdiction = await project.tax_engine.resolve_jurisdiction(taxRateId)
+    tax_breakdown, total_tax = project.tax_engine.compute_taxes(
+        tax_table, jurisdiction, taxable_lines
+    )
+    subtotal = total_service_cost + total_parts_cost
+    total_amount_due = subtotal + total_tax
+    invoice_number = await project.invoice_number_service.invoice_numbers.next_number(
+        userId
+    )
+    try:
+        invoice = await prisma.models.Invoice.prisma().create(
             data={
-                "invoiceId": invoice.id,
-                "serviceId": "",
-                "rateId": "",
-                "partId": part.partId,
+                "userId": userId,
+                "invoiceNumber": invoice_number,
+                "dueDate": datetime.datetime.strptime(dueDate, "%Y-%m-%d"),
+                "totalAmount": total_amount_due,
+                "currency": currency,
+                "subtotal": subtotal,
+                "totalTax": total_tax,
+                "taxBreakdown": prisma.Json(
+                    [item.model_dump(mode="json") for item in tax_breakdown]
+                ),
+                # Unknown rates charge no tax and would break the TaxRate foreign key.
+                "taxRateId": taxRateId if jurisdiction is not None else None,
+                "status": "DRAFT",
+                "BillableItems": {"create": billable_items},
             }
         )
+    except Exception:
+        await project.invoice_number_service.invoice_numbers.discard(
+            userId, invoice_number, "invoice creation failed"
+        )
+        raise
+    project.database.record_write(userId, invoice.id)
+    project.search_invoices_service.search_index.index_invoice(
+        invoice.id, userId, invoice.createdAt, line_items
+    )
     return CreateInvoiceOutput(
-        invoiceId=invoice.id, status=invoice.status, totalAmount=total_amount_due
+        invoiceId=invoice.id,
+        invoiceNumber=project.invoice_number_service.format_invoice_number(
+            invoice_number
+        ),
+        status=invoice.status,
+        subtotal=subtotal,
+        totalTax=total_tax,
+        totalAmount=total_amount_due,
+        taxBreakdown=tax_breakdown,
     )
@@ -0,0 +1,143 @@
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple, TypeVar
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from prisma import Prisma
+
+READ_YOUR_WRITES_WINDOW = float(os.getenv("READ_YOUR_WRITES_WINDOW", "5"))
+
+T = TypeVar("T")
+
+_recent_writes: Dict[str, float] = {}
+
+# (expiry, key) pairs in the order they were recorded. The window is fixed, so this is
+# also expiry order and expired keys can be dropped from the left.
+_write_expiries: Deque[Tuple[float, str]] = deque()
+
+
+def with_pool_size(url: Optional[str], pool_size: Optional[str]) -> Optional[str]:
+    """
+    Sets the Prisma `connection_limit` query parameter on a database URL.
+
+    Args:
+    url (Optional[str]): The database connection URL.
+    pool_size (Optional[str]): The maximum number of pooled connections, None to keep the URL as is.
+
+    Returns:
+    Optional[str]: The connection URL carrying the requested pool size.
+    """
+    if not url or not pool_size:
+        return url
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query))
+    query["connection_limit"] = pool_size
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def _client(url: Optional[str], **kwargs) -> Prisma:
+    if url:
+        return Prisma(datasource={"url": url}, **kwargs)
+    return Prisma(**kwargs)
+
+
+db_client = _client(
+    with_pool_size(os.getenv("DATABASE_URL"), os.getenv("DATABASE_POOL_SIZE")),
+    auto_register=True,
+)
+
+_read_database_url = with_pool_size(
+    os.getenv("READ_DATABASE_URL"), os.getenv("READ_DATABASE_POOL_SIZE")
+)
+
+read_db_client: Optional[Prisma] = (
+    _client(_read_database_url) if _read_database_url else None
+)
+
+
+def record_write(*keys: Optional[str]) -> None:
+    """
+    Marks the given keys (user ids, emails, transaction ids) as recently written so that
+    reads for them stay on the primary until the replica has caught up.
+
+    Args:
+    *keys (Optional[str]): Identifiers touched by the write. None values are ignored.
+    """
+    if read_db_client is None:
+        return
+    now = time.monotonic()
+    expires_at = now + READ_YOUR_WRITES_WINDOW
+    for key in keys:
+        if key:
+            _recent_writes[key] = expires_at
+            _write_expiries.append((expires_at, key))
+    while _write_expiries and _write_expiries[0][0] <= now:
+        expiry, key = _write_expiries.popleft()
+        # The key may have been written again since, with a later expiry.
+        if _recent_writes.get(key) == expiry:
+            del _recent_writes[key]
+
+
+def reader(key: Optional[str] = None) -> Prisma:
+    """
+    Picks the client a read-only query should run against.
+
+    Args:
+    key (Optional[str]): Identifier of the data being read, used for read-your-writes.
+
+    Returns:
+    Prisma: The read replica client, or the primary when no replica is configured or
+    the key was written by this process within the last READ_YOUR_WRITES_WINDOW seconds.
+    Writes made by other instances are not tracked here; lookups that must see them use
+    find_with_fallback.
+    """
+    if read_db_client is None:
+        return db_client
+    if key is not None:
+        expiry = _recent_writes.get(key)
+        if expiry is not None:
+            if expiry > time.monotonic():
+                return db_client
+            del _recent_writes[key]
+    return read_db_client
+
+
+async def find_with_fallback(
+    key: Optional[str], query: Callable[[Prisma], Awaitable[Optional[T]]]
+) -> Optional[T]:
+    """
+    Runs a single-record lookup on the client picked by `reader` and repeats it on the
+    primary when the replica has no such record. A row written moments ago by another
+    instance may not have replicated yet, so a replica miss is never trusted on its own.
+
+    Args:
+    key (Optional[str]): Identifier of the data being read, used for read-your-writes.
+    query (Callable[[Prisma], Awaitable[Optional[T]]]): Runs the lookup on a given client.
+
+    Returns:
+    Optional[T]: The record, or None if the primary does not have it either.
+    """
+    client = reader(key)
+    result = await query(client)
+    if result is None and client is not db_client:
+        result = await query(db_client)
+    return result
+
+
+async def connect() -> None:
+    """
+    Connects the primary client and, when configured, the read replica client.
+    """
+    await db_client.connect()
+    if read_db_client is not None:
+        await read_db_client.connect()
+
+
+async def disconnect() -> None:
+    """
+    Disconnects every configured database client.
+    """
+    if read_db_client is not None:
+        await read_db_client.disconnect()
+    await db_client.disconnect()
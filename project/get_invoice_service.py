@@ -0,0 +1,227 @@
+import hashlib
+import os
+from collections import OrderedDict
+from datetime import datetime
+from typing import List, NamedTuple, Optional
+
+import prisma
+import prisma.models
+import project.database
+import project.invoice_number_service
+import project.tax_engine
+from pydantic import BaseModel
+
+INVOICE_CACHE_SIZE = int(os.getenv("INVOICE_CACHE_SIZE", "1024"))
+
+
+class InvoiceLineItem(BaseModel):
+    """
+    A billed service or part on the invoice, at the description and price it was
+    billed at.
+    """
+
+    id: str
+    serviceId: Optional[str] = None
+    rateId: Optional[str] = None
+    partId: Optional[str] = None
+    description: Optional[str] = None
+    quantity: Optional[float] = None
+    unitPrice: Optional[float] = None
+    amount: Optional[float] = None
+
+
+class InvoicePayment(BaseModel):
+    """
+    A payment made against the invoice.
+    """
+
+    id: str
+    amount: float
+    currency: str
+    paymentDate: datetime
+    paymentMethod: str
+    transactionId: Optional[str] = None
+    status: str
+
+
+class InvoiceDetail(BaseModel):
+    """
+    The full invoice with its line items, payments and tax breakdown.
+    """
+
+    id: str
+    invoiceNumber: Optional[str] = None
+    userId: str
+    status: str
+    currency: str
+    subtotal: Optional[float] = None
+    totalTax: Optional[float] = None
+    totalAmount: float
+    dueDate: Optional[datetime] = None
+    createdAt: datetime
+    updatedAt: datetime
+    taxRateId: Optional[str] = None
+    taxBreakdown: List[project.tax_engine.TaxBreakdownItem]
+    lineItems: List[InvoiceLineItem]
+    payments: List[InvoicePayment]
+
+
+class CachedInvoice(NamedTuple):
+    etag: str
+    content: bytes
+
+
+class InvoiceResponse(NamedTuple):
+    """
+    A serialized invoice and its ETag. `content` is None when the client's copy, named in
+    If-None-Match, is still current.
+    """
+
+    etag: str
+    content: Optional[bytes]
+
+
+_cache: "OrderedDict[str, CachedInvoice]" = OrderedDict()
+
+
+def make_etag(invoice_id: str, updated_at: datetime) -> str:
+    """
+    Builds the strong ETag of an invoice version. The payload is built only from the
+    invoice, its billable items and its payments, and every write to those bumps
+    `Invoice.updatedAt`, so the pair identifies the serialized payload exactly. Catalog
+    rows (Service, Rate, Part, TaxRate) are not part of the payload; the invoice carries
+    its own snapshot of what was billed.
+    """
+    digest = hashlib.sha256(f"{invoice_id}:{updated_at.isoformat()}".encode())
+    return f'"{digest.hexdigest()[:32]}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Evaluates an If-None-Match header against the current ETag. Weak validators are
+    compared by their opaque tag, as RFC 9110 requires for If-None-Match.
+    """
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def serialize_invoice(invoice: prisma.models.Invoice) -> bytes:
+    """
+    Renders an invoice loaded with its relations as the JSON body of GET /invoice/{id}.
+    """
+    detail = InvoiceDetail(
+        id=invoice.id,
+        invoiceNumber=(
+            project.invoice_number_service.format_invoice_number(invoice.invoiceNumber)
+            if invoice.invoiceNumber is not None
+            else None
+        ),
+        userId=invoice.userId,
+        status=invoice.status,
+        currency=invoice.currency,
+        subtotal=invoice.subtotal,
+        totalTax=invoice.totalTax,
+        totalAmount=invoice.totalAmount,
+        dueDate=invoice.dueDate,
+        createdAt=invoice.createdAt,
+        updatedAt=invoice.updatedAt,
+        taxRateId=invoice.taxRateId,
+        taxBreakdown=invoice.taxBreakdown or [],
+        lineItems=[
+            InvoiceLineItem(
+                id=item.id,
+                serviceId=item.serviceId or None,
+                rateId=item.rateId or None,
+                partId=item.partId or None,
+                description=item.description,
+                quantity=item.quantity,
+                unitPrice=item.unitPrice,
+                amount=item.amount,
+            )
+            for item in invoice.BillableItems or []
+        ],
+        payments=[
+            InvoicePayment(
+                id=payment.id,
+                amount=payment.amount,
+                currency=payment.currency,
+                paymentDate=payment.paymentDate,
+                paymentMethod=payment.paymentMethod,
+                transactionId=payment.transactionId,
+                status=payment.status,
+            )
+            for payment in invoice.Payments or []
+        ],
+    )
+    return detail.model_dump_json().encode()
+
+
+def _remember(invoice_id: str, cached: CachedInvoice) -> None:
+    _cache[invoice_id] = cached
+    _cache.move_to_end(invoice_id)
+    while len(_cache) > INVOICE_CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+async def get_invoice(
+    id: str, if_none_match: Optional[str] = None
+) -> Optional[InvoiceResponse]:
+    """
+    Fetches an invoice with its line items, payments and tax breakdown.
+
+    When the invoice is cached or the client sent If-None-Match, only the invoice row is
+    read to learn its current `updatedAt`. A matching ETag is answered without loading or
+    serializing anything else, and a cached payload for the same version is reused.
+    Otherwise the whole graph is loaded in one query with its relations included. Reads
+    go to the replica when one is configured and fall back to the primary on a miss.
+
+    Args:
+        id (str): Unique identifier of the invoice.
+        if_none_match (Optional[str]): The If-None-Match request header.
+
+    Returns:
+        Optional[InvoiceResponse]: The serialized invoice and its ETag, with no content if
+        the client's copy is current. None if the invoice does not exist.
+    """
+    cached = _cache.get(id)
+    if cached is not None or if_none_match:
+        invoice = await project.database.find_with_fallback(
+            id,
+            lambda client: prisma.models.Invoice.prisma(client).find_unique(
+                where={"id": id}
+            ),
+        )
+        if invoice is None:
+            _cache.pop(id, None)
+            return None
+        etag = make_etag(invoice.id, invoice.updatedAt)
+        if etag_matches(if_none_match, etag):
+            return InvoiceResponse(etag=etag, content=None)
+        if cached is not None and cached.etag == etag:
+            _cache.move_to_end(id)
+            return InvoiceResponse(etag=etag, content=cached.content)
+    invoice = await project.database.find_with_fallback(
+        id,
+        lambda client: prisma.models.Invoice.prisma(client).find_unique(
+            where={"id": id},
+            include={"BillableItems": True, "Payments": True},
+        ),
+    )
+    if invoice is None:
+        _cache.pop(id, None)
+        return None
+    cached = CachedInvoice(
+        etag=make_etag(invoice.id, invoice.updatedAt),
+        content=serialize_invoice(invoice),
+    )
+    _remember(id, cached)
+    return InvoiceResponse(etag=cached.etag, content=cached.content)
@@ -5,6 +5,7 @@ from typing import Optional
 import prisma
 import prisma.enums
 import prisma.models
+import project.database
 from pydantic import BaseModel
 
 
@@ -52,6 +53,7 @@ async def initiate_payment(
     await prisma.models.Invoice.prisma().update(
         where={"id": invoice_id}, data={"status": prisma.enums.InvoiceStatus.SENT}
     )
+    project.database.record_write(user_id, invoice_id, transaction_id)
     payment_response = InitiatePaymentResponse(
         transaction_id=transaction_id,
         status="Initiated",
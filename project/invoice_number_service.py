@@ -0,0 +1,341 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+import prisma
+import prisma.models
+import project.database
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+MAX_BLOCK_SIZE = int(os.getenv("INVOICE_NUMBER_BLOCK_SIZE", "100"))
+
+BLOCK_TARGET_SECONDS = float(os.getenv("INVOICE_NUMBER_BLOCK_TARGET", "10"))
+
+HEARTBEAT_INTERVAL = float(os.getenv("INVOICE_NUMBER_HEARTBEAT_INTERVAL", "30"))
+
+HEARTBEAT_TIMEOUT = float(os.getenv("INVOICE_NUMBER_HEARTBEAT_TIMEOUT", "300"))
+
+INVOICE_NUMBER_PREFIX = "INV-"
+
+
+class LeasedBlock(BaseModel):
+    """
+    A range of invoice numbers [next, end) leased to this worker for one tenant.
+    """
+
+    id: str
+    tenantId: str
+    next: int
+    end: int
+    size: int
+    leasedAt: float
+
+
+def format_invoice_number(number: int) -> str:
+    """
+    Renders an invoice number the way it is printed on invoices, e.g. INV-000042.
+    """
+    return f"{INVOICE_NUMBER_PREFIX}{number:06d}"
+
+
+def missing_ranges(start: int, end: int, used: List[int]) -> List[Tuple[int, int]]:
+    """
+    Lists the sub-ranges of [start, end) not covered by `used`.
+
+    Args:
+    start (int): First number of the range.
+    end (int): End of the range, exclusive.
+    used (List[int]): Numbers of the range that were issued.
+
+    Returns:
+    List[Tuple[int, int]]: The unused [start, end) ranges, in order.
+    """
+    gaps = []
+    cursor = start
+    for number in sorted(used):
+        if number > cursor:
+            gaps.append((cursor, number))
+        cursor = max(cursor, number + 1)
+    if cursor < end:
+        gaps.append((cursor, end))
+    return gaps
+
+
+def next_block_size(
+    size: int,
+    elapsed: float,
+    target: float = BLOCK_TARGET_SECONDS,
+    maximum: int = MAX_BLOCK_SIZE,
+) -> int:
+    """
+    Sizes a tenant's next block from how long its previous one lasted, so busy tenants
+    lease rarely and quiet tenants do not strand many numbers in idle blocks.
+
+    Args:
+    size (int): Size of the block that was just used up.
+    elapsed (float): Seconds it took to use it up.
+    target (float): How long a block should last.
+    maximum (int): Largest block size handed out.
+
+    Returns:
+    int: Double the size if the block lasted under half the target, half of it if it
+    lasted over twice the target, otherwise the same size; always within [1, maximum].
+    """
+    if elapsed < target / 2:
+        size *= 2
+    elif elapsed > target * 2:
+        size //= 2
+    return max(1, min(size, maximum))
+
+
+async def record_gap(
+    tenant_id: str,
+    start: int,
+    end: int,
+    reason: str,
+    client: Optional[prisma.Prisma] = None,
+) -> None:
+    """
+    Writes the range [start, end) of a tenant's invoice numbers to the gap audit table.
+    """
+    if start >= end:
+        return
+    await prisma.models.InvoiceNumberGap.prisma(client).create(
+        data={"tenantId": tenant_id, "start": start, "end": end, "reason": reason}
+    )
+
+
+class InvoiceNumberAllocator:
+    """
+    Hands out sequential per-tenant invoice numbers from blocks leased hi-lo style.
+
+    Leasing a block bumps the tenant's counter row by the block size and records the
+    block in one transaction, so workers only contend on that row once per block instead
+    of once per invoice. Numbers within a block are handed out from memory under a
+    per-tenant asyncio lock. Block sizes adapt per tenant, starting at 1. A block is used
+    until it runs out, and its unused tail goes back to the counter on release when no
+    other worker has leased since; otherwise it ends up in InvoiceNumberGap.
+    """
+
+    def __init__(
+        self,
+        max_block_size: int = MAX_BLOCK_SIZE,
+        block_target_seconds: float = BLOCK_TARGET_SECONDS,
+        worker_id: Optional[str] = None,
+    ) -> None:
+        self.max_block_size = max_block_size
+        self.block_target_seconds = block_target_seconds
+        self.worker_id = worker_id or (
+            f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        )
+        self._blocks: Dict[str, LeasedBlock] = {}
+        self._block_sizes: Dict[str, int] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def _lease_block(
+        self, tenant_id: str, size: int, used_up: Optional[LeasedBlock]
+    ) -> LeasedBlock:
+        async with project.database.db_client.tx() as transaction:
+            if used_up is not None:
+                await prisma.models.InvoiceNumberBlock.prisma(transaction).update_many(
+                    where={"id": used_up.id, "releasedAt": None},
+                    data={"releasedAt": datetime.now(timezone.utc)},
+                )
+            counters = prisma.models.InvoiceNumberCounter.prisma(transaction)
+            increment = {"nextValue": {"increment": size}}
+            counter = await counters.update(
+                where={"tenantId": tenant_id}, data=increment
+            )
+            if counter is None:
+                await counters.create_many(
+                    data=[{"tenantId": tenant_id}], skip_duplicates=True
+                )
+                counter = await counters.update(
+                    where={"tenantId": tenant_id}, data=increment
+                )
+            block = await prisma.models.InvoiceNumberBlock.prisma(transaction).create(
+                data={
+                    "tenantId": tenant_id,
+                    "start": counter.nextValue - size,
+                    "end": counter.nextValue,
+                    "leasedBy": self.worker_id,
+                }
+            )
+        return LeasedBlock(
+            id=block.id,
+            tenantId=tenant_id,
+            next=block.start,
+            end=block.end,
+            size=size,
+            leasedAt=time.monotonic(),
+        )
+
+    async def _release_block(self, block: LeasedBlock, reason: str) -> None:
+        async with project.database.db_client.tx() as transaction:
+            blocks = prisma.models.InvoiceNumberBlock.prisma(transaction)
+            released = await blocks.update_many(
+                where={"id": block.id, "releasedAt": None},
+                data={"releasedAt": datetime.now(timezone.utc)},
+            )
+            if not released or block.next >= block.end:
+                return
+            returned = await prisma.models.InvoiceNumberCounter.prisma(
+                transaction
+            ).update_many(
+                where={"tenantId": block.tenantId, "nextValue": block.end},
+                data={"nextValue": block.next},
+            )
+            if returned:
+                await blocks.update(where={"id": block.id}, data={"end": block.next})
+            else:
+                await record_gap(
+                    block.tenantId, block.next, block.end, reason, transaction
+                )
+
+    async def next_number(self, tenant_id: str) -> int:
+        """
+        Returns the next invoice number for a tenant, leasing a new block when the current
+        one is used up.
+
+        Args:
+        tenant_id (str): The tenant (issuing user) the invoice belongs to.
+
+        Returns:
+        int: A number no other invoice of the tenant has or will receive.
+        """
+        lock = self._locks.setdefault(tenant_id, asyncio.Lock())
+        async with lock:
+            block = self._blocks.get(tenant_id)
+            if block is None or block.next >= block.end:
+                if block is None:
+                    size = self._block_sizes.get(tenant_id, 1)
+                else:
+                    size = next_block_size(
+                        block.size,
+                        time.monotonic() - block.leasedAt,
+                        self.block_target_seconds,
+                        self.max_block_size,
+                    )
+                block = await self._lease_block(tenant_id, size, block)
+                self._blocks[tenant_id] = block
+                self._block_sizes[tenant_id] = size
+            number = block.next
+            block.next += 1
+            return number
+
+    async def discard(self, tenant_id: str, number: int, reason: str) -> None:
+        """
+        Records a number that was handed out but not used, e.g. because the invoice
+        insert failed.
+        """
+        await record_gap(tenant_id, number, number + 1, reason)
+
+    async def heartbeat(self) -> int:
+        """
+        Marks this worker's blocks as alive. Blocks that were reconciled in the meantime,
+        e.g. after a long stall, are dropped so the next invoice leases a fresh block.
+
+        Returns:
+        int: The number of blocks still held.
+        """
+        if not self._blocks:
+            return 0
+        blocks = prisma.models.InvoiceNumberBlock.prisma()
+        held = await blocks.update_many(
+            where={"leasedBy": self.worker_id, "releasedAt": None},
+            data={"heartbeatAt": datetime.now(timezone.utc)},
+        )
+        if held < len(self._blocks):
+            lost = await blocks.find_many(
+                where={
+                    "id": {"in": [block.id for block in self._blocks.values()]},
+                    "releasedAt": {"not": None},
+                }
+            )
+            lost_ids = {block.id for block in lost}
+            for tenant_id, block in list(self._blocks.items()):
+                if block.id in lost_ids:
+                    logger.warning(
+                        "Invoice number block %s was reconciled while leased", block.id
+                    )
+                    del self._blocks[tenant_id]
+        return len(self._blocks)
+
+    async def release_all(self) -> None:
+        """
+        Releases every leased block, returning unused tails to the counter or the gap
+        audit table. Called on shutdown so a graceful restart leaves no unreconciled
+        blocks behind.
+        """
+        blocks, self._blocks = list(self._blocks.values()), {}
+        for block in blocks:
+            await self._release_block(block, "worker shutdown")
+
+
+async def reconcile_abandoned_blocks(timeout: float = HEARTBEAT_TIMEOUT) -> int:
+    """
+    Finds unreleased blocks whose worker stopped heartbeating, i.e. crashed, and records
+    the numbers in them that no invoice received as gaps.
+
+    Args:
+    timeout (float): Seconds without a heartbeat after which a block is abandoned.
+
+    Returns:
+    int: The number of blocks reconciled.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=timeout)
+    blocks = await prisma.models.InvoiceNumberBlock.prisma().find_many(
+        where={"releasedAt": None, "heartbeatAt": {"lt": cutoff}}
+    )
+    reconciled = 0
+    for block in blocks:
+        released = await prisma.models.InvoiceNumberBlock.prisma().update_many(
+            where={"id": block.id, "releasedAt": None, "heartbeatAt": {"lt": cutoff}},
+            data={"releasedAt": datetime.now(timezone.utc)},
+        )
+        if not released:
+            continue
+        reconciled += 1
+        invoices = await prisma.models.Invoice.prisma().find_many(
+            where={
+                "userId": block.tenantId,
+                "invoiceNumber": {"gte": block.start, "lt": block.end},
+            }
+        )
+        for start, end in missing_ranges(
+            block.start, block.end, [invoice.invoiceNumber for invoice in invoices]
+        ):
+            await record_gap(block.tenantId, start, end, "worker crashed")
+    if reconciled:
+        logger.info("Reconciled %d abandoned invoice number blocks", reconciled)
+    return reconciled
+
+
+invoice_numbers = InvoiceNumberAllocator()
+
+
+async def run_block_maintenance(stop: asyncio.Event) -> None:
+    """
+    Heartbeats this worker's blocks and reconciles blocks abandoned by crashed workers,
+    every HEARTBEAT_INTERVAL seconds until `stop` is set.
+
+    Args:
+    stop (asyncio.Event): Set to shut the task down.
+    """
+    while not stop.is_set():
+        try:
+            await invoice_numbers.heartbeat()
+            await reconcile_abandoned_blocks()
+        except Exception:
+            logger.exception("Error maintaining invoice number blocks")
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=HEARTBEAT_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
@@ -2,6 +2,7 @@ from datetime import datetime
 
 import prisma
 import prisma.models
+import project.database
 from jose import jwt
 from passlib.context import CryptContext
 from pydantic import BaseModel
@@ -47,7 +48,12 @@ async def get_user_by_email(email: str) -> prisma.models.User | None:
     Returns:
     User | None: The user object if found, None otherwise.
     """
-    return await prisma.models.User.prisma().find_unique(where={"email": email})
+    return await project.database.find_with_fallback(
+        email,
+        lambda client: prisma.models.User.prisma(client).find_unique(
+            where={"email": email}
+        ),
+    )
 
 
 async def authenticate_user(email: str, password: str) -> prisma.models.User | None:
@@ -0,0 +1,373 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import prisma
+import prisma.enums
+import prisma.models
+import project.database
+from pydantic import BaseModel, ValidationError
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_SECRET = os.getenv("PAYMENT_WEBHOOK_SECRET", "")
+
+WEBHOOK_BATCH_SIZE = int(os.getenv("PAYMENT_WEBHOOK_BATCH_SIZE", "500"))
+
+WEBHOOK_POLL_INTERVAL = float(os.getenv("PAYMENT_WEBHOOK_POLL_INTERVAL", "1"))
+
+WEBHOOK_CLAIM_TIMEOUT = float(os.getenv("PAYMENT_WEBHOOK_CLAIM_TIMEOUT", "300"))
+
+# Payments are floats; a sum within half a cent of the invoice total pays it in full.
+AMOUNT_TOLERANCE = 0.005
+
+CONSUMER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+GATEWAY_STATUSES = {
+    "pending": prisma.enums.PaymentStatus.PENDING,
+    "processing": prisma.enums.PaymentStatus.PENDING,
+    "succeeded": prisma.enums.PaymentStatus.COMPLETED,
+    "completed": prisma.enums.PaymentStatus.COMPLETED,
+    "paid": prisma.enums.PaymentStatus.COMPLETED,
+    "failed": prisma.enums.PaymentStatus.FAILED,
+    "canceled": prisma.enums.PaymentStatus.FAILED,
+    "cancelled": prisma.enums.PaymentStatus.FAILED,
+}
+
+STATUS_PRECEDENCE = {
+    prisma.enums.PaymentStatus.PENDING: 0,
+    prisma.enums.PaymentStatus.FAILED: 1,
+    prisma.enums.PaymentStatus.COMPLETED: 2,
+}
+
+_wakeup = asyncio.Event()
+
+
+class InvalidSignatureError(ValueError):
+    """
+    Raised when a webhook delivery is not signed with the configured secret.
+    """
+
+
+class InvalidWebhookPayloadError(ValueError):
+    """
+    Raised when a webhook body is not a gateway event this service understands.
+    """
+
+
+class GatewayEvent(BaseModel):
+    """
+    A payment status change as delivered by the payment gateway.
+    """
+
+    id: str
+    transaction_id: str
+    status: str
+    amount: Optional[float] = None
+    created_at: datetime
+
+
+class PaymentWebhookResponse(BaseModel):
+    """
+    Acknowledges that a webhook delivery was queued for processing.
+    """
+
+    received: bool
+    eventId: str
+
+
+def sign_payload(body: bytes, secret: str = WEBHOOK_SECRET) -> str:
+    """
+    Computes the hex HMAC-SHA256 signature the gateway sends in the X-Signature header.
+
+    Args:
+    body (bytes): The raw request body.
+    secret (str): The shared webhook secret.
+
+    Returns:
+    str: The hex encoded signature.
+    """
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def verify_signature(body: bytes, signature: Optional[str]) -> None:
+    """
+    Checks a webhook signature in constant time. Both "<hex>" and "sha256=<hex>" are accepted.
+
+    Args:
+    body (bytes): The raw request body.
+    signature (Optional[str]): The value of the X-Signature header.
+    """
+    if not WEBHOOK_SECRET:
+        raise InvalidSignatureError("Payment webhook secret is not configured.")
+    if not signature:
+        raise InvalidSignatureError("Missing webhook signature.")
+    if signature.startswith("sha256="):
+        signature = signature[len("sha256=") :]
+    if not hmac.compare_digest(sign_payload(body, WEBHOOK_SECRET), signature):
+        raise InvalidSignatureError("Invalid webhook signature.")
+
+
+def parse_event(body: bytes) -> GatewayEvent:
+    """
+    Parses a webhook body and validates that its status is one the gateway documents.
+    Raises InvalidWebhookPayloadError for bodies that are not valid gateway events.
+    """
+    try:
+        event = GatewayEvent.model_validate_json(body)
+    except ValidationError as e:
+        raise InvalidWebhookPayloadError(f"Invalid webhook payload: {e}") from e
+    if event.status.lower() not in GATEWAY_STATUSES:
+        raise InvalidWebhookPayloadError(f"Unknown payment status: {event.status}")
+    if event.created_at.tzinfo is None:
+        event.created_at = event.created_at.replace(tzinfo=timezone.utc)
+    return event
+
+
+async def enqueue_events(events: List[GatewayEvent]) -> int:
+    """
+    Appends gateway events to the durable webhook queue. Events already queued (same
+    gateway event id) are skipped, so redeliveries are harmless.
+
+    Args:
+    events (List[GatewayEvent]): The events to queue.
+
+    Returns:
+    int: The number of newly queued events.
+    """
+    if not events:
+        return 0
+    count = await prisma.models.PaymentWebhookEvent.prisma().create_many(
+        data=[
+            {
+                "eventId": event.id,
+                "transactionId": event.transaction_id,
+                "status": GATEWAY_STATUSES[event.status.lower()],
+                "amount": event.amount,
+                "occurredAt": event.created_at,
+                "payload": prisma.Json(event.model_dump(mode="json")),
+            }
+            for event in events
+        ],
+        skip_duplicates=True,
+    )
+    _wakeup.set()
+    return count
+
+
+async def receive_payment_webhook(
+    body: bytes, signature: Optional[str]
+) -> PaymentWebhookResponse:
+    """
+    Verifies and queues a payment gateway webhook delivery. Payment and invoice statuses are
+    updated later by the background consumer, so the gateway gets its acknowledgement
+    without waiting on those writes.
+
+    Args:
+    body (bytes): The raw request body, as signed by the gateway.
+    signature (Optional[str]): The value of the X-Signature header.
+
+    Returns:
+    PaymentWebhookResponse: Acknowledges that the delivery was queued for processing.
+    """
+    verify_signature(body, signature)
+    event = parse_event(body)
+    await enqueue_events([event])
+    return PaymentWebhookResponse(received=True, eventId=event.id)
+
+
+def coalesce_events(
+    events: List[prisma.models.PaymentWebhookEvent],
+) -> Dict[str, prisma.models.PaymentWebhookEvent]:
+    """
+    Reduces queued events to the one that determines each transaction's status: the latest
+    by gateway timestamp, with a final status winning over PENDING on ties. Duplicate and
+    out-of-order deliveries therefore collapse to a single update per transaction.
+
+    Args:
+    events (List[prisma.models.PaymentWebhookEvent]): Queued events in any order.
+
+    Returns:
+    Dict[str, prisma.models.PaymentWebhookEvent]: The winning event per transaction id.
+    """
+    latest: Dict[str, prisma.models.PaymentWebhookEvent] = {}
+    for event in events:
+        current = latest.get(event.transactionId)
+        if current is None or (
+            event.occurredAt,
+            STATUS_PRECEDENCE[event.status],
+        ) > (current.occurredAt, STATUS_PRECEDENCE[current.status]):
+            latest[event.transactionId] = event
+    return latest
+
+
+def _not_above(
+    status: prisma.enums.PaymentStatus,
+) -> List[prisma.enums.PaymentStatus]:
+    return [
+        other
+        for other, precedence in STATUS_PRECEDENCE.items()
+        if precedence <= STATUS_PRECEDENCE[status]
+    ]
+
+
+async def claim_events(
+    batch_size: int = WEBHOOK_BATCH_SIZE, consumer_id: str = CONSUMER_ID
+) -> List[prisma.models.PaymentWebhookEvent]:
+    """
+    Atomically claims up to `batch_size` unprocessed events for one consumer, oldest first.
+    Rows locked by a concurrent claim are skipped rather than waited on, so consumers on
+    other instances claim disjoint batches. Events claimed more than
+    WEBHOOK_CLAIM_TIMEOUT seconds ago and still unprocessed, e.g. because their consumer
+    died, can be claimed again.
+
+    Args:
+    batch_size (int): The maximum number of events to claim.
+    consumer_id (str): Identifies the claiming consumer.
+
+    Returns:
+    List[prisma.models.PaymentWebhookEvent]: The claimed events.
+    """
+    return await prisma.models.PaymentWebhookEvent.prisma().query_raw(
+        """
+        UPDATE "PaymentWebhookEvent"
+        SET "claimedBy" = $1, "claimedAt" = now() AT TIME ZONE 'UTC'
+        WHERE "id" IN (
+            SELECT "id" FROM "PaymentWebhookEvent"
+            WHERE "processedAt" IS NULL
+              AND (
+                "claimedAt" IS NULL
+                OR "claimedAt"
+                  < (now() AT TIME ZONE 'UTC') - $3::float8 * interval '1 second'
+              )
+            ORDER BY "receivedAt"
+            LIMIT $2::int
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING *
+        """,
+        consumer_id,
+        batch_size,
+        WEBHOOK_CLAIM_TIMEOUT,
+    )
+
+
+async def process_pending_events(
+    batch_size: int = WEBHOOK_BATCH_SIZE, consumer_id: str = CONSUMER_ID
+) -> int:
+    """
+    Claims one batch of queued webhook events and applies it to `Payment` and `Invoice`
+    in a single transaction, marking the batch as processed.
+
+    A payment only moves to an event's status if that event is not older than the last
+    one applied (`Payment.gatewayUpdatedAt`), so events that arrive after a later batch
+    has already been applied are ignored. At the same timestamp a final status is never
+    demoted to PENDING, as in `coalesce_events`. Re-queued events are applied again, so
+    a replay repairs payments a faulty consumer got wrong. Events for transactions
+    without a `Payment` row are logged and dropped. A completed payment takes the amount the gateway
+    captured, and an invoice moves to PAID only once its COMPLETED payments add up to
+    its total, so partial payments leave it open.
+
+    Args:
+    batch_size (int): The maximum number of queued events to claim.
+    consumer_id (str): Identifies this consumer in the claim.
+
+    Returns:
+    int: The number of events consumed from the queue.
+    """
+    events = await claim_events(batch_size, consumer_id)
+    if not events:
+        return 0
+    latest = coalesce_events(events)
+    payments = await prisma.models.Payment.prisma().find_many(
+        where={"transactionId": {"in": list(latest)}}
+    )
+    unknown = latest.keys() - {payment.transactionId for payment in payments}
+    if unknown:
+        logger.warning(
+            "Dropping webhook events for %d unknown transactions: %s",
+            len(unknown),
+            ", ".join(sorted(unknown)),
+        )
+    invoice_ids = sorted({payment.invoiceId for payment in payments})
+    now = datetime.now(timezone.utc)
+    async with project.database.db_client.batch_() as batcher:
+        for transaction_id, event in latest.items():
+            data = {"status": event.status, "gatewayUpdatedAt": event.occurredAt}
+            if event.status == prisma.enums.PaymentStatus.COMPLETED:
+                data["paymentDate"] = event.occurredAt
+                if event.amount is not None:
+                    data["amount"] = event.amount
+            batcher.payment.update_many(
+                where={
+                    "transactionId": transaction_id,
+                    "OR": [
+                        {"gatewayUpdatedAt": None},
+                        {"gatewayUpdatedAt": {"lt": event.occurredAt}},
+                        {
+                            "gatewayUpdatedAt": event.occurredAt,
+                            "status": {"in": _not_above(event.status)},
+                        },
+                    ],
+                },
+                data=data,
+            )
+        if invoice_ids:
+            # Bump the invoice version so cached GET /invoice/{id} payloads and ETags
+            # reflect the new payment status.
+            batcher.invoice.update_many(
+                where={"id": {"in": invoice_ids}}, data={"updatedAt": now}
+            )
+            placeholders = ", ".join(f"${i + 2}" for i in range(len(invoice_ids)))
+            batcher.execute_raw(
+                f"""
+                UPDATE "Invoice" SET "status" = 'PAID'
+                WHERE "id" IN ({placeholders})
+                  AND "status" <> 'PAID'
+                  AND "totalAmount" <= $1::float8 + (
+                    SELECT COALESCE(SUM(p."amount"), 0) FROM "Payment" p
+                    WHERE p."invoiceId" = "Invoice"."id" AND p."status" = 'COMPLETED'
+                  )
+                """,
+                AMOUNT_TOLERANCE,
+                *invoice_ids,
+            )
+        batcher.paymentwebhookevent.update_many(
+            where={
+                "id": {"in": [event.id for event in events]},
+                "claimedBy": consumer_id,
+            },
+            data={"processedAt": now},
+        )
+    project.database.record_write(*latest, *invoice_ids)
+    return len(events)
+
+
+async def run_webhook_consumer(stop: asyncio.Event) -> None:
+    """
+    Drains the webhook queue until `stop` is set. The consumer wakes up as soon as a
+    delivery is queued by this process and otherwise polls every
+    WEBHOOK_POLL_INTERVAL seconds to pick up events queued by other workers.
+
+    Args:
+    stop (asyncio.Event): Set to shut the consumer down.
+    """
+    while not stop.is_set():
+        _wakeup.clear()
+        try:
+            processed = await process_pending_events()
+        except Exception:
+            logger.exception("Error processing payment webhook events")
+            processed = 0
+        if processed >= WEBHOOK_BATCH_SIZE:
+            continue
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=WEBHOOK_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
@@ -2,6 +2,8 @@ from typing import Optional
 
 import prisma
 import prisma.models
+import project.database
+import project.search_invoices_service
 from pydantic import BaseModel
 
 
@@ -65,6 +67,10 @@ async def register_user(
             },
         }
     )
+    project.database.record_write(new_user.id, email)
+    project.search_invoices_service.search_index.index_profile(
+        new_user.id, first_name, last_name, company_name, tax_id
+    )
     return UserRegistrationResponse(
         user_id=new_user.id, message="User successfully registered."
     )
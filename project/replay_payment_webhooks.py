@@ -0,0 +1,130 @@
+"""
+Replays payment gateway webhook events, for backfills after an outage or a consumer bug.
+
+Usage:
+    python -m project.replay_payment_webhooks --file events.jsonl
+    python -m project.replay_payment_webhooks --since 2024-04-01T00:00:00Z
+
+`--file` queues gateway events exported as JSON lines (one webhook body per line); events
+already in the queue are skipped. `--since`/`--until` re-queue events that were already
+received in that window. Either way the queue is then drained with the same coalescing
+consumer the server runs: the latest event of each payment is applied again, overwriting
+whatever a faulty consumer wrote, while events older than a payment's current status
+are ignored.
+"""
+
+import argparse
+import asyncio
+import logging
+from datetime import datetime
+from typing import Optional
+
+import prisma
+import prisma.models
+import project.database
+import project.payment_webhook_service
+
+logger = logging.getLogger(__name__)
+
+
+async def requeue_events(since: datetime, until: Optional[datetime]) -> int:
+    """
+    Marks events received in [since, until) as unprocessed so the consumer applies them again.
+
+    Args:
+    since (datetime): Start of the window, inclusive.
+    until (Optional[datetime]): End of the window, exclusive. None for no upper bound.
+
+    Returns:
+    int: The number of events re-queued.
+    """
+    received_at = {"gte": since}
+    if until is not None:
+        received_at["lt"] = until
+    return await prisma.models.PaymentWebhookEvent.prisma().update_many(
+        where={"receivedAt": received_at},
+        data={"processedAt": None, "claimedBy": None, "claimedAt": None},
+    )
+
+
+async def enqueue_file(path: str, batch_size: int) -> int:
+    """
+    Queues gateway events read from a JSON lines file.
+
+    Args:
+    path (str): Path to the file, one webhook body per line.
+    batch_size (int): Number of events inserted per query.
+
+    Returns:
+    int: The number of newly queued events.
+    """
+    queued = 0
+    batch = []
+    with open(path, "rb") as events_file:
+        for line in events_file:
+            if not line.strip():
+                continue
+            batch.append(project.payment_webhook_service.parse_event(line))
+            if len(batch) >= batch_size:
+                queued += await project.payment_webhook_service.enqueue_events(batch)
+                batch = []
+    queued += await project.payment_webhook_service.enqueue_events(batch)
+    return queued
+
+
+async def replay(
+    path: Optional[str],
+    since: Optional[datetime],
+    until: Optional[datetime],
+    batch_size: int,
+) -> int:
+    """
+    Queues or re-queues the requested events and drains the queue.
+
+    Returns:
+    int: The number of events applied.
+    """
+    await project.database.connect()
+    try:
+        if path:
+            queued = await enqueue_file(path, batch_size)
+            logger.info("Queued %d events from %s", queued, path)
+        if since:
+            requeued = await requeue_events(since, until)
+            logger.info("Re-queued %d events", requeued)
+        applied = 0
+        while True:
+            processed = await project.payment_webhook_service.process_pending_events(
+                batch_size
+            )
+            if not processed:
+                return applied
+            applied += processed
+            logger.info("Applied %d events", applied)
+    finally:
+        await project.database.disconnect()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--file", help="JSON lines file of gateway webhook bodies")
+    parser.add_argument(
+        "--since", type=datetime.fromisoformat, help="re-queue events received from"
+    )
+    parser.add_argument(
+        "--until", type=datetime.fromisoformat, help="re-queue events received before"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=project.payment_webhook_service.WEBHOOK_BATCH_SIZE,
+    )
+    args = parser.parse_args()
+    if not args.file and not args.since:
+        parser.error("one of --file or --since is required")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(replay(args.file, args.since, args.until, args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
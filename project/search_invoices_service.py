@@ -0,0 +1,617 @@
+import asyncio
+import bisect
+import heapq
+import logging
+import os
+import re
+import sys
+import uuid
+from array import array
+from datetime import datetime, timedelta
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
+
+import prisma
+import prisma.models
+import project.database
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+TAX_ID_WEIGHT = 4.0
+
+COMPANY_WEIGHT = 3.0
+
+NAME_WEIGHT = 2.0
+
+LINE_ITEM_WEIGHT = 1.0
+
+PREFIX_MATCH_FACTOR = 0.5
+
+MAX_PREFIX_EXPANSIONS = 64
+
+MIN_PREFIX_LENGTH = 3
+
+MAX_SEARCH_CANDIDATES = int(os.getenv("MAX_SEARCH_CANDIDATES", "250000"))
+
+SEARCH_YIELD_INTERVAL = 1000
+
+BUILD_BATCH_SIZE = 5000
+
+SEARCH_REFRESH_INTERVAL = float(os.getenv("SEARCH_REFRESH_INTERVAL", "30"))
+
+REFRESH_OVERLAP = timedelta(seconds=5)
+
+_TOKEN_RE = re.compile(r"[0-9a-z]+")
+
+
+class QueryTooBroadError(Exception):
+    """
+    Raised when even the most selective term of a query matches more than
+    MAX_SEARCH_CANDIDATES invoices.
+    """
+
+
+class InvoiceSearchResult(BaseModel):
+    """
+    A single invoice matching the search query, with the customer it was issued for.
+    """
+
+    invoiceId: str
+    userId: str
+    customerName: Optional[str] = None
+    companyName: Optional[str] = None
+    score: float
+
+
+class InvoiceSearchResponse(BaseModel):
+    """
+    A page of ranked invoice search results.
+    """
+
+    query: str
+    total: int
+    page: int
+    page_size: int
+    results: List[InvoiceSearchResult]
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """
+    Splits free text into lowercase alphanumeric tokens. Punctuation is dropped, so a tax
+    id like "12-345/6" becomes ["12", "345", "6"].
+
+    Args:
+    text (Optional[str]): The text to tokenize.
+
+    Returns:
+    List[str]: The tokens in order of appearance.
+    """
+    if not text:
+        return []
+    # Interned so the many profiles and invoices sharing a term share one string.
+    return [sys.intern(token) for token in _TOKEN_RE.findall(text.lower())]
+
+
+def _compact_id(value: str) -> Union[bytes, str]:
+    # Row ids are gen_random_uuid() strings; their 16 raw bytes take about half the
+    # memory of the 36 character string.
+    try:
+        parsed = uuid.UUID(value)
+    except ValueError:
+        return value
+    return parsed.bytes if str(parsed) == value else value
+
+
+def _expand_id(value: Union[bytes, str]) -> str:
+    return str(uuid.UUID(bytes=value)) if isinstance(value, bytes) else value
+
+
+class PrefixIndex:
+    """
+    Every indexed term in sorted order, used to expand a query prefix to full terms.
+
+    Inserts and removals are buffered and merged into the sorted list on the next
+    expansion, so indexing a batch of rows does not pay for keeping the list sorted.
+    """
+
+    def __init__(self) -> None:
+        self._terms: List[str] = []
+        self._added: Set[str] = set()
+        self._removed: Set[str] = set()
+
+    def insert(self, term: str) -> None:
+        if term in self._removed:
+            self._removed.discard(term)
+        else:
+            self._added.add(term)
+
+    def discard(self, term: str) -> None:
+        if term in self._added:
+            self._added.discard(term)
+        else:
+            self._removed.add(term)
+
+    def _merge(self) -> None:
+        if self._removed:
+            removed = self._removed
+            self._terms = [term for term in self._terms if term not in removed]
+            self._removed = set()
+        if self._added:
+            self._terms.extend(self._added)
+            self._terms.sort()
+            self._added = set()
+
+    def expand(self, prefix: str, limit: int = MAX_PREFIX_EXPANSIONS) -> List[str]:
+        """
+        Lists up to `limit` indexed terms starting with `prefix`, shortest first.
+        """
+        if not prefix:
+            return []
+        self._merge()
+        successor = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        low = bisect.bisect_left(self._terms, prefix)
+        high = bisect.bisect_left(self._terms, successor, low)
+        return heapq.nsmallest(limit, self._terms[low:high], key=len)
+
+
+class InvoiceSearchIndex:
+    """
+    In-memory inverted index over invoices, laid out to stay compact at millions of rows.
+
+    Invoices are numbered densely as they are added. Per-invoice data lives in arrays
+    indexed by that number, invoice ids are kept as raw UUID bytes, posting lists are
+    `array("i")` of invoice or user numbers, and the sorted term tuple of each invoice is
+    interned, so invoices billing the same services and parts share one tuple.
+
+    Customer fields (name, company, tax id) are indexed per user and fanned out to that
+    user's invoices at query time, so a profile update touches one posting list entry per
+    term instead of one per invoice. Line item descriptions are indexed per invoice.
+    """
+
+    def __init__(self) -> None:
+        self._doc_numbers: Dict[Union[bytes, str], int] = {}
+        self._doc_ids: List[Union[bytes, str]] = []
+        self._doc_owner = array("i")
+        self._doc_created = array("d")
+        self._doc_terms: List[Tuple[str, ...]] = []
+        self._term_sets: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+        self._invoice_postings: Dict[str, array] = {}
+        self._user_numbers: Dict[str, int] = {}
+        self._user_ids: List[str] = []
+        self._user_docs: List[array] = []
+        self._user_terms: List[Dict[str, float]] = []
+        self._profiles: List[Tuple[str, Optional[str]]] = []
+        self._user_postings: Dict[str, array] = {}
+        self._prefixes = PrefixIndex()
+
+    def __len__(self) -> int:
+        return len(self._doc_ids)
+
+    def _is_indexed(self, term: str) -> bool:
+        return term in self._invoice_postings or term in self._user_postings
+
+    def _user_number(self, user_id: str) -> int:
+        number = self._user_numbers.get(user_id)
+        if number is None:
+            number = len(self._user_ids)
+            self._user_numbers[user_id] = number
+            self._user_ids.append(user_id)
+            self._user_docs.append(array("i"))
+            self._user_terms.append({})
+            self._profiles.append(("", None))
+        return number
+
+    def index_profile(
+        self,
+        user_id: str,
+        first_name: Optional[str],
+        last_name: Optional[str],
+        company_name: Optional[str],
+        tax_id: Optional[str],
+    ) -> None:
+        """
+        Adds or replaces the searchable customer fields of a user.
+        """
+        user = self._user_number(user_id)
+        customer_name = " ".join(part for part in (first_name, last_name) if part)
+        self._profiles[user] = (customer_name, company_name)
+        weights: Dict[str, float] = {}
+        for text, weight in (
+            (customer_name, NAME_WEIGHT),
+            (company_name, COMPANY_WEIGHT),
+            (tax_id, TAX_ID_WEIGHT),
+            ("".join(tokenize(tax_id)), TAX_ID_WEIGHT),
+        ):
+            for term in tokenize(text):
+                weights[term] = max(weights.get(term, 0.0), weight)
+        for term in self._user_terms[user].keys() - weights.keys():
+            posting = self._user_postings[term]
+            posting.remove(user)
+            if not posting:
+                del self._user_postings[term]
+                if not self._is_indexed(term):
+                    self._prefixes.discard(term)
+        for term in weights.keys() - self._user_terms[user].keys():
+            if not self._is_indexed(term):
+                self._prefixes.insert(term)
+                self._user_postings[term] = array("i")
+            elif term not in self._user_postings:
+                self._user_postings[term] = array("i")
+            self._user_postings[term].append(user)
+        self._user_terms[user] = weights
+
+    def index_invoice(
+        self,
+        invoice_id: str,
+        user_id: str,
+        created_at: Optional[datetime],
+        line_items: Iterable[Optional[str]],
+    ) -> None:
+        """
+        Adds or replaces an invoice and the descriptions of its line items.
+        """
+        user = self._user_number(user_id)
+        terms = tuple(sorted({term for text in line_items for term in tokenize(text)}))
+        terms = self._term_sets.setdefault(terms, terms)
+        created = created_at.timestamp() if created_at else 0.0
+        key = _compact_id(invoice_id)
+        doc = self._doc_numbers.get(key)
+        if doc is None:
+            doc = len(self._doc_ids)
+            self._doc_numbers[key] = doc
+            self._doc_ids.append(key)
+            self._doc_owner.append(user)
+            self._doc_created.append(created)
+            self._doc_terms.append(())
+            self._user_docs[user].append(doc)
+            previous_terms: Tuple[str, ...] = ()
+        else:
+            self._doc_created[doc] = created
+            if self._doc_owner[doc] != user:
+                self._user_docs[self._doc_owner[doc]].remove(doc)
+                self._user_docs[user].append(doc)
+                self._doc_owner[doc] = user
+            previous_terms = self._doc_terms[doc]
+            if previous_terms is terms:
+                return
+        self._doc_terms[doc] = terms
+        for term in set(previous_terms) - set(terms):
+            posting = self._invoice_postings[term]
+            posting.remove(doc)
+            if not posting:
+                del self._invoice_postings[term]
+                if not self._is_indexed(term):
+                    self._prefixes.discard(term)
+        for term in set(terms) - set(previous_terms):
+            if term not in self._invoice_postings:
+                if term not in self._user_postings:
+                    self._prefixes.insert(term)
+                self._invoice_postings[term] = array("i")
+            self._invoice_postings[term].append(doc)
+
+    def _expansions(self, term: str, prefix: bool) -> List[Tuple[str, float]]:
+        expansions = [(term, 1.0)]
+        if prefix:
+            expansions += [
+                (expansion, PREFIX_MATCH_FACTOR)
+                for expansion in self._prefixes.expand(term)
+                if expansion != term
+            ]
+        return expansions
+
+    def _estimate(self, expansions: List[Tuple[str, float]]) -> int:
+        size = 0
+        for expansion, _ in expansions:
+            size += len(self._invoice_postings.get(expansion, ()))
+            for user in self._user_postings.get(expansion, ()):
+                size += len(self._user_docs[user])
+        return size
+
+    def _user_scores(self, expansions: List[Tuple[str, float]]) -> Dict[int, float]:
+        scores: Dict[int, float] = {}
+        for expansion, factor in expansions:
+            for user in self._user_postings.get(expansion, ()):
+                weight = self._user_terms[user][expansion] * factor
+                if scores.get(user, 0.0) < weight:
+                    scores[user] = weight
+        return scores
+
+    async def _materialize(
+        self, expansions: List[Tuple[str, float]]
+    ) -> Dict[int, float]:
+        scores: Dict[int, float] = {}
+        pending = 0
+        for user, weight in self._user_scores(expansions).items():
+            docs = self._user_docs[user]
+            for doc in docs:
+                scores[doc] = weight
+            pending += len(docs)
+            if pending >= SEARCH_YIELD_INTERVAL:
+                pending = 0
+                await asyncio.sleep(0)
+        for expansion, factor in expansions:
+            weight = LINE_ITEM_WEIGHT * factor
+            posting = self._invoice_postings.get(expansion, array("i"))
+            for start in range(0, len(posting), SEARCH_YIELD_INTERVAL):
+                for doc in posting[start : start + SEARCH_YIELD_INTERVAL]:
+                    if scores.get(doc, 0.0) < weight:
+                        scores[doc] = weight
+                await asyncio.sleep(0)
+        return scores
+
+    async def _filter(
+        self, totals: Dict[int, float], expansions: List[Tuple[str, float]]
+    ) -> Dict[int, float]:
+        # Scores are computed once per user and once per interned line item tuple, so
+        # each candidate invoice costs two dict lookups.
+        user_scores = self._user_scores(expansions)
+        factors = dict(expansions)
+        line_item_scores: Dict[Tuple[str, ...], float] = {}
+        owners = self._doc_owner
+        doc_terms = self._doc_terms
+        filtered: Dict[int, float] = {}
+        for position, (doc, total) in enumerate(totals.items()):
+            if position % SEARCH_YIELD_INTERVAL == SEARCH_YIELD_INTERVAL - 1:
+                await asyncio.sleep(0)
+            terms = doc_terms[doc]
+            line_item_score = line_item_scores.get(terms)
+            if line_item_score is None:
+                line_item_score = LINE_ITEM_WEIGHT * max(
+                    (factors.get(term, 0.0) for term in terms), default=0.0
+                )
+                line_item_scores[terms] = line_item_score
+            score = max(user_scores.get(owners[doc], 0.0), line_item_score)
+            if score:
+                filtered[doc] = total + score
+        return filtered
+
+    async def _top(
+        self, totals: Dict[int, float], count: int
+    ) -> List[Tuple[int, float]]:
+        by_score: Dict[float, List[int]] = {}
+        for position, (doc, score) in enumerate(totals.items()):
+            if position % SEARCH_YIELD_INTERVAL == SEARCH_YIELD_INTERVAL - 1:
+                await asyncio.sleep(0)
+            by_score.setdefault(score, []).append(doc)
+        page: List[Tuple[int, float]] = []
+        for score in sorted(by_score, reverse=True):
+            if len(page) >= count:
+                break
+            # Invoices are mostly numbered in creation order, so walking them newest
+            # first keeps the heap from being rebuilt on every candidate.
+            docs = by_score[score]
+            docs.reverse()
+            wanted = count - len(page)
+            if wanted >= len(docs):
+                newest = sorted(docs, key=self._doc_created.__getitem__, reverse=True)
+            else:
+                # Kept to `wanted` after every chunk so the loop can yield in between.
+                newest = []
+                for start in range(0, len(docs), SEARCH_YIELD_INTERVAL):
+                    newest = heapq.nlargest(
+                        wanted,
+                        newest + docs[start : start + SEARCH_YIELD_INTERVAL],
+                        key=self._doc_created.__getitem__,
+                    )
+                    await asyncio.sleep(0)
+            page.extend((doc, score) for doc in newest)
+        return page
+
+    async def search(
+        self, query: str, offset: int = 0, limit: int = 20
+    ) -> Tuple[int, List[Tuple[str, float]]]:
+        """
+        Finds invoices matching every term of the query. The last term also matches as a
+        prefix, at a reduced score, once it is at least MIN_PREFIX_LENGTH characters
+        long. Results are ranked by summed term weight, newest first on ties.
+
+        The rarest whole term is expanded through the posting lists; the remaining terms
+        are checked against each candidate's owner and line items, so the cost follows
+        the most selective term rather than the most common one. Queries whose rarest
+        term matches more than MAX_SEARCH_CANDIDATES invoices are refused, and the
+        scoring loops yield to the event loop every SEARCH_YIELD_INTERVAL candidates, so
+        a broad query does not stall other requests.
+
+        Raises:
+        QueryTooBroadError: If the query is not selective enough.
+
+        Returns:
+        Tuple[int, List[Tuple[str, float]]]: The total match count and the requested page
+        of (invoice id, score) pairs.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return 0, []
+        clauses = [
+            self._expansions(
+                term, position == len(terms) - 1 and len(term) >= MIN_PREFIX_LENGTH
+            )
+            for position, term in enumerate(terms)
+        ]
+        whole_terms = clauses[:-1] or clauses
+        estimates = [self._estimate(expansions) for expansions in whole_terms]
+        driver = min(range(len(estimates)), key=estimates.__getitem__)
+        if estimates[driver] > MAX_SEARCH_CANDIDATES:
+            raise QueryTooBroadError(
+                "The query matches too many invoices, add more terms to narrow it down"
+            )
+        totals = await self._materialize(clauses[driver])
+        for position, expansions in enumerate(clauses):
+            if position == driver or not totals:
+                continue
+            totals = await self._filter(totals, expansions)
+        page = (await self._top(totals, offset + limit))[offset:]
+        return len(totals), [
+            (_expand_id(self._doc_ids[doc]), score) for doc, score in page
+        ]
+
+    def owner(self, invoice_id: str) -> Optional[str]:
+        doc = self._doc_numbers.get(_compact_id(invoice_id))
+        return None if doc is None else self._user_ids[self._doc_owner[doc]]
+
+    def profile(self, user_id: str) -> Tuple[Optional[str], Optional[str]]:
+        user = self._user_numbers.get(user_id)
+        return (None, None) if user is None else self._profiles[user]
+
+
+search_index = InvoiceSearchIndex()
+
+
+def line_item_text(
+    service: Optional[prisma.models.Service], part: Optional[prisma.models.Part]
+) -> str:
+    """
+    Builds the searchable description of a billable item from its service or part.
+    """
+    texts = []
+    for item in (service, part):
+        if item is not None:
+            texts.append(item.name)
+            if item.description:
+                texts.append(item.description)
+    return " ".join(texts)
+
+
+_profiles_synced_to: Optional[datetime] = None
+
+_invoices_synced_to: Optional[datetime] = None
+
+
+async def _changed_rows(
+    model: Type[prisma.models.UserProfile] | Type[prisma.models.Invoice],
+    since: Optional[datetime],
+    **kwargs: Any,
+) -> AsyncIterator[List[Any]]:
+    """
+    Yields batches of rows updated after `since` (all rows when None), oldest first.
+    """
+    where = {"updatedAt": {"gt": since - REFRESH_OVERLAP}} if since else {}
+    cursor: Optional[str] = None
+    while True:
+        rows = await model.prisma(project.database.reader()).find_many(
+            where=where,
+            take=BUILD_BATCH_SIZE,
+            order=[{"updatedAt": "asc"}, {"id": "asc"}],
+            **({"cursor": {"id": cursor}, "skip": 1} if cursor else {}),
+            **kwargs,
+        )
+        if rows:
+            yield rows
+        if len(rows) < BUILD_BATCH_SIZE:
+            return
+        cursor = rows[-1].id
+
+
+async def refresh_search_index() -> int:
+    """
+    Indexes the user profiles and invoices changed since the previous refresh, or every
+    row on the first call. Rows come from the read replica when one is configured, in
+    batches of BUILD_BATCH_SIZE, so a cold build never holds more than one batch of rows.
+
+    Each refresh looks REFRESH_OVERLAP further back than the newest row it has seen, so
+    rows committed late by other instances are still picked up; re-indexing a row that
+    did not change is cheap.
+
+    Returns:
+    int: The number of profiles and invoices indexed.
+    """
+    global _profiles_synced_to, _invoices_synced_to
+    indexed = 0
+    async for profiles in _changed_rows(prisma.models.UserProfile, _profiles_synced_to):
+        for profile in profiles:
+            search_index.index_profile(
+                profile.userId,
+                profile.firstName,
+                profile.lastName,
+                profile.companyName,
+                profile.taxId,
+            )
+        indexed += len(profiles)
+        _profiles_synced_to = profiles[-1].updatedAt
+    async for invoices in _changed_rows(
+        prisma.models.Invoice,
+        _invoices_synced_to,
+        include={"BillableItems": {"include": {"Service": True, "Part": True}}},
+    ):
+        for invoice in invoices:
+            # Index the description billed on the invoice, as create_invoice does, so a
+            # later catalog rename does not change what the invoice is found by. Rows
+            # created before descriptions were stored fall back to the catalog.
+            search_index.index_invoice(
+                invoice.id,
+                invoice.userId,
+                invoice.createdAt,
+                [
+                    item.description or line_item_text(item.Service, item.Part)
+                    for item in invoice.BillableItems or []
+                ],
+            )
+        indexed += len(invoices)
+        _invoices_synced_to = invoices[-1].updatedAt
+    return indexed
+
+
+async def run_search_index_refresher(stop: asyncio.Event) -> None:
+    """
+    Builds the search index in the background and then keeps it in sync with writes made
+    by other instances, refreshing every SEARCH_REFRESH_INTERVAL seconds until `stop` is
+    set. Searches are served from the partial index while the first build runs.
+
+    Args:
+    stop (asyncio.Event): Set to shut the refresher down.
+    """
+    while not stop.is_set():
+        try:
+            indexed = await refresh_search_index()
+            logger.debug("Indexed %d changed profiles and invoices", indexed)
+        except Exception:
+            logger.exception("Error refreshing the invoice search index")
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=SEARCH_REFRESH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def search_invoices(q: str, page: int, page_size: int) -> InvoiceSearchResponse:
+    """
+    Searches invoices by customer name, company, tax id and line item description.
+
+    Args:
+    q (str): Free text query. Every term must match; the last one may be a prefix.
+    page (int): 1-based page number, validated by the endpoint.
+    page_size (int): Number of results per page (1-100), validated by the endpoint.
+
+    Raises:
+    QueryTooBroadError: If the query matches too many invoices to rank.
+
+    Returns:
+    InvoiceSearchResponse: A page of ranked invoice search results.
+    """
+    total, hits = await search_index.search(q, (page - 1) * page_size, page_size)
+    results = []
+    for invoice_id, score in hits:
+        user_id = search_index.owner(invoice_id) or ""
+        customer_name, company_name = search_index.profile(user_id)
+        results.append(
+            InvoiceSearchResult(
+                invoiceId=invoice_id,
+                userId=user_id,
+                customerName=customer_name or None,
+                companyName=company_name,
+                score=score,
+            )
+        )
+    return InvoiceSearchResponse(
+        query=q, total=total, page=page, page_size=page_size, results=results
+    )
@@ -1,29 +1,53 @@
+import asyncio
 import logging
 from contextlib import asynccontextmanager
 from typing import List, Optional
 
 import project.create_invoice_service
+import project.database
+import project.get_invoice_service
 import project.initiate_payment_service
+import project.invoice_number_service
 import project.login_user_service
+import project.payment_webhook_service
 import project.register_user_service
+import project.search_invoices_service
+import project.tax_engine
 import project.update_invoice_service
 import project.update_profile_service
 import project.verify_payment_service
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, Query, Request
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import Response
-from prisma import Prisma
+from fastapi.responses import JSONResponse, Response
 
 logger = logging.getLogger(__name__)
 
-db_client = Prisma(auto_register=True)
+db_client = project.database.db_client
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await db_client.connect()
+    await project.database.connect()
+    await project.tax_engine.load_tax_table()
+    stop_background_tasks = asyncio.Event()
+    background_tasks = [
+        asyncio.create_task(
+            project.search_invoices_service.run_search_index_refresher(
+                stop_background_tasks
+            )
+        ),
+        asyncio.create_task(
+            project.payment_webhook_service.run_webhook_consumer(stop_background_tasks)
+        ),
+        asyncio.create_task(
+            project.invoice_number_service.run_block_maintenance(stop_background_tasks)
+        ),
+    ]
     yield
-    await db_client.disconnect()
+    stop_background_tasks.set()
+    await asyncio.gather(*background_tasks)
+    await project.invoice_number_service.invoice_numbers.release_all()
+    await project.database.disconnect()
 
 
 app = FastAPI(
@@ -57,6 +81,65 @@ async def api_get_verify_payment(
         )
 
 
+@app.get(
+    "/invoices/search",
+    response_model=project.search_invoices_service.InvoiceSearchResponse,
+)
+async def api_get_search_invoices(
+    q: str,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(20, ge=1, le=100),
+) -> project.search_invoices_service.InvoiceSearchResponse | Response:
+    """
+    Searches invoices by customer name, company, tax id and line item description.
+    """
+    try:
+        res = await project.search_invoices_service.search_invoices(q, page, page_size)
+        return res
+    except project.search_invoices_service.QueryTooBroadError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    except Exception as e:
+        logger.exception("Error processing request")
+        res = dict()
+        res["error"] = str(e)
+        return Response(
+            content=jsonable_encoder(res),
+            status_code=500,
+            media_type="application/json",
+        )
+
+
+@app.post(
+    "/payment/webhook",
+    response_model=project.payment_webhook_service.PaymentWebhookResponse,
+    status_code=202,
+)
+async def api_post_payment_webhook(
+    request: Request, x_signature: Optional[str] = Header(None)
+) -> project.payment_webhook_service.PaymentWebhookResponse | Response:
+    """
+    Receives a signed payment status event from the payment gateway and queues it.
+    """
+    try:
+        res = await project.payment_webhook_service.receive_payment_webhook(
+            await request.body(), x_signature
+        )
+        return res
+    except project.payment_webhook_service.InvalidSignatureError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=401)
+    except project.payment_webhook_service.InvalidWebhookPayloadError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    except Exception as e:
+        logger.exception("Error processing request")
+        res = dict()
+        res["error"] = str(e)
+        return Response(
+            content=jsonable_encoder(res),
+            status_code=500,
+            media_type="application/json",
+        )
+
+
 @app.put(
     "/profile/update",
     response_model=project.update_profile_service.UserProfileUpdateResponse,
@@ -144,6 +227,35 @@ async def api_post_register_user(
         )
 
 
+@app.get("/invoice/{id}", response_model=project.get_invoice_service.InvoiceDetail)
+async def api_get_invoice(
+    id: str, if_none_match: Optional[str] = Header(None)
+) -> Response:
+    """
+    Fetches an invoice with its line items, payments and tax details.
+    """
+    try:
+        res = await project.get_invoice_service.get_invoice(id, if_none_match)
+        if res is None:
+            return JSONResponse(content={"error": "Invoice not found"}, status_code=404)
+        if res.content is None:
+            return Response(status_code=304, headers={"ETag": res.etag})
+        return Response(
+            content=res.content,
+            media_type="application/json",
+            headers={"ETag": res.etag, "Cache-Control": "no-cache"},
+        )
+    except Exception as e:
+        logger.exception("Error processing request")
+        res = dict()
+        res["error"] = str(e)
+        return Response(
+            content=jsonable_encoder(res),
+            status_code=500,
+            media_type="application/json",
+        )
+
+
 @app.put(
     "/invoice/{id}/update",
     response_model=project.update_invoice_service.InvoiceUpdateResponse,
@@ -193,6 +305,8 @@ async def api_post_create_invoice(
             userId, services, parts, taxRateId, dueDate
         )
         return res
+    except project.create_invoice_service.InvalidInvoiceError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
     except Exception as e:
         logger.exception("Error processing request")
         res = dict()
@@ -0,0 +1,208 @@
+import asyncio
+import os
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+import prisma
+import prisma.enums
+import prisma.models
+import project.database
+from pydantic import BaseModel
+
+SERVICE = prisma.enums.TaxApplicableTo.SERVICE
+
+GOODS = prisma.enums.TaxApplicableTo.GOODS
+
+TAX_TABLE_TTL = float(os.getenv("TAX_TABLE_TTL", "300"))
+
+MAX_UNKNOWN_TAX_RATES = 10000
+
+
+class TaxBreakdownItem(BaseModel):
+    """
+    The tax charged under a single rate, itemized on the invoice.
+    """
+
+    taxRateId: str
+    name: str
+    percentage: float
+    applicableTo: prisma.enums.TaxApplicableTo
+    taxableAmount: float
+    taxAmount: float
+
+
+class ApplicableRate(NamedTuple):
+    id: str
+    name: str
+    percentage: float
+    applicableTo: prisma.enums.TaxApplicableTo
+
+
+def jurisdiction_key(tax_rate: prisma.models.TaxRate) -> str:
+    """
+    Returns the key of the rates charged together with `tax_rate`. Rates only stack when
+    they explicitly share a jurisdiction, e.g. a state and a county rate; a rate without
+    one forms a jurisdiction of its own, keyed by its id.
+    """
+    return tax_rate.jurisdiction or tax_rate.id
+
+
+class TaxTable:
+    """
+    Tax rates grouped by jurisdiction and line kind (SERVICE or GOODS).
+
+    A BOTH rate is listed under both kinds, so pricing a line is a single dict lookup.
+    """
+
+    def __init__(self, tax_rates: Iterable[prisma.models.TaxRate]) -> None:
+        self._jurisdictions: Dict[str, str] = {}
+        rates: Dict[Tuple[str, prisma.enums.TaxApplicableTo], List[ApplicableRate]] = (
+            defaultdict(list)
+        )
+        for tax_rate in tax_rates:
+            jurisdiction = jurisdiction_key(tax_rate)
+            self._jurisdictions[tax_rate.id] = jurisdiction
+            rate = ApplicableRate(
+                tax_rate.id,
+                tax_rate.name,
+                tax_rate.percentage,
+                tax_rate.applicableTo,
+            )
+            for kind in (SERVICE, GOODS):
+                if tax_rate.applicableTo in (kind, prisma.enums.TaxApplicableTo.BOTH):
+                    rates[(jurisdiction, kind)].append(rate)
+        self._rates = {key: tuple(value) for key, value in rates.items()}
+
+    def jurisdiction_of(self, tax_rate_id: str) -> Optional[str]:
+        return self._jurisdictions.get(tax_rate_id)
+
+    def rates_for(
+        self, jurisdiction: str, kind: prisma.enums.TaxApplicableTo
+    ) -> Tuple[ApplicableRate, ...]:
+        return self._rates.get((jurisdiction, kind), ())
+
+
+_tax_table: Optional[TaxTable] = None
+
+_loaded_at = 0.0
+
+_load_lock = asyncio.Lock()
+
+_unknown_tax_rates: Set[str] = set()
+
+
+async def load_tax_table(client: Optional[prisma.Prisma] = None) -> TaxTable:
+    """
+    Reads every TaxRate row and replaces the in-memory tax table.
+
+    Args:
+    client (Optional[prisma.Prisma]): The client to read from, the read replica when
+    one is configured by default.
+
+    Returns:
+    TaxTable: The freshly built table.
+    """
+    global _tax_table, _loaded_at
+    tax_rates = await prisma.models.TaxRate.prisma(
+        client or project.database.reader()
+    ).find_many()
+    _tax_table = TaxTable(tax_rates)
+    _loaded_at = time.monotonic()
+    _unknown_tax_rates.clear()
+    return _tax_table
+
+
+async def get_tax_table() -> TaxTable:
+    """
+    Returns the in-memory tax table, loading it on first use and reloading it once it is
+    older than TAX_TABLE_TTL seconds, so rate changes made on any instance are picked up.
+    Concurrent callers share a single reload.
+    """
+    if _tax_table is None or time.monotonic() - _loaded_at >= TAX_TABLE_TTL:
+        async with _load_lock:
+            if _tax_table is None or time.monotonic() - _loaded_at >= TAX_TABLE_TTL:
+                return await load_tax_table()
+    return _tax_table
+
+
+async def resolve_jurisdiction(
+    tax_rate_id: Optional[str],
+) -> Tuple[TaxTable, Optional[str]]:
+    """
+    Finds the jurisdiction a tax rate belongs to.
+
+    A rate missing from the table is looked up by id, and the table is reloaded from the
+    primary only if the rate exists, so rates added since the last load are picked up
+    immediately even while the read replica lags behind. Ids that do not exist are
+    remembered until the next reload and cost no further queries.
+
+    Args:
+    tax_rate_id (Optional[str]): The tax rate chosen for the invoice.
+
+    Returns:
+    Tuple[TaxTable, Optional[str]]: The tax table and the jurisdiction, None if the rate
+    does not exist.
+    """
+    table = await get_tax_table()
+    if not tax_rate_id:
+        return table, None
+    jurisdiction = table.jurisdiction_of(tax_rate_id)
+    if jurisdiction is not None or tax_rate_id in _unknown_tax_rates:
+        return table, jurisdiction
+    tax_rate = await project.database.find_with_fallback(
+        tax_rate_id,
+        lambda client: prisma.models.TaxRate.prisma(client).find_unique(
+            where={"id": tax_rate_id}
+        ),
+    )
+    if tax_rate is None:
+        if len(_unknown_tax_rates) >= MAX_UNKNOWN_TAX_RATES:
+            _unknown_tax_rates.clear()
+        _unknown_tax_rates.add(tax_rate_id)
+        return table, None
+    async with _load_lock:
+        table = await load_tax_table(project.database.db_client)
+    return table, table.jurisdiction_of(tax_rate_id) or jurisdiction_key(tax_rate)
+
+
+def compute_taxes(
+    table: TaxTable,
+    jurisdiction: Optional[str],
+    lines: Iterable[Tuple[prisma.enums.TaxApplicableTo, float]],
+) -> Tuple[List[TaxBreakdownItem], float]:
+    """
+    Taxes each invoice line under every rate of the jurisdiction that applies to its kind:
+    the chosen rate and any rate explicitly sharing its jurisdiction.
+
+    Args:
+    table (TaxTable): The precomputed tax table.
+    jurisdiction (Optional[str]): The invoice's jurisdiction. None means no tax is charged.
+    lines (Iterable[Tuple[TaxApplicableTo, float]]): (kind, amount) pairs, kind being
+    SERVICE or GOODS.
+
+    Returns:
+    Tuple[List[TaxBreakdownItem], float]: The tax charged per rate and the total tax.
+    """
+    if jurisdiction is None:
+        return [], 0
+    # Lines of a kind are taxed under the same rates, so sum them per kind first.
+    kind_totals: Dict[prisma.enums.TaxApplicableTo, float] = {}
+    for kind, amount in lines:
+        kind_totals[kind] = kind_totals.get(kind, 0) + amount
+    taxable: Dict[ApplicableRate, float] = {}
+    for kind, amount in kind_totals.items():
+        for rate in table.rates_for(jurisdiction, kind):
+            taxable[rate] = taxable.get(rate, 0) + amount
+    breakdown = [
+        TaxBreakdownItem(
+            taxRateId=rate.id,
+            name=rate.name,
+            percentage=rate.percentage,
+            applicableTo=rate.applicableTo,
+            taxableAmount=amount,
+            taxAmount=amount * rate.percentage / 100,
+        )
+        for rate, amount in taxable.items()
+    ]
+    return breakdown, sum(item.taxAmount for item in breakdown)
@@ -2,6 +2,8 @@ from typing import Optional
 
 import prisma
 import prisma.models
+import project.database
+import project.search_invoices_service
 from pydantic import BaseModel
 
 
@@ -59,6 +61,14 @@ async def update_profile(
         },
     )
     if updated_profile:
+        project.database.record_write(userId)
+        project.search_invoices_service.search_index.index_profile(
+            updated_profile.userId,
+            updated_profile.firstName,
+            updated_profile.lastName,
+            updated_profile.companyName,
+            updated_profile.taxId,
+        )
         updated_user_profile_model = UserProfileModel(
             firstName=updated_profile.firstName,
             lastName=updated_profile.lastName,
@@ -1,7 +1,9 @@
 from typing import Optional
 
 import prisma
+import prisma.enums
 import prisma.models
+import project.database
 from pydantic import BaseModel
 
 
@@ -26,12 +28,17 @@ async def verify_payment(transactionId: str) -> VerifyPaymentResponse:
         VerifyPaymentResponse: The response provides details on the verified payment transaction,
         including its current status.
 
-    This function queries the database for a payment transaction matching the provided transactionId.
-    It then verifies the status of the transaction and returns details including the transaction status
-    and any error message if the transaction failed.
+    This function queries the read replica for a payment transaction matching the provided
+    transactionId, falling back to the primary right after this instance initiated it or
+    when the replica does not have it yet.
+    It returns the status last reported by the payment gateway webhook, with an error message
+    if the payment is still pending or failed.
     """
-    payment_record = await prisma.models.Payment.prisma().find_unique(
-        where={"transactionId": transactionId}
+    payment_record = await project.database.find_with_fallback(
+        transactionId,
+        lambda client: prisma.models.Payment.prisma(client).find_unique(
+            where={"transactionId": transactionId}
+        ),
     )
     if not payment_record:
         return VerifyPaymentResponse(
@@ -39,12 +46,12 @@ async def verify_payment(transactionId: str) -> VerifyPaymentResponse:
             status="Failed",
             errorMessage="Transaction not found",
         )
-    status = (
-        "Completed"
-        if payment_record.amount and payment_record.paymentDate
-        else "Pending"
-    )
-    errorMessage = None if status == "Completed" else "Payment is pending or incomplete"
+    if payment_record.status == prisma.enums.PaymentStatus.COMPLETED:
+        status, errorMessage = "Completed", None
+    elif payment_record.status == prisma.enums.PaymentStatus.FAILED:
+        status, errorMessage = "Failed", "Payment was declined by the payment gateway"
+    else:
+        status, errorMessage = "Pending", "Payment is pending or incomplete"
     return VerifyPaymentResponse(
         transactionId=transactionId, status=status, errorMessage=errorMessage
     )
@@ -0,0 +1,31 @@
+"""
+Shared fixtures.
+
+Tests that need PostgreSQL use the `database` fixture and are skipped unless
+DATABASE_URL points at a database with the schema pushed (`prisma db push`). Tests that
+exercise read replica routing also need READ_DATABASE_URL, pointing at a second database
+with the same schema; see "Running the tests" in the README.
+"""
+
+import os
+
+import project.database
+import pytest
+
+
+@pytest.fixture
+async def database():
+    if not os.getenv("DATABASE_URL"):
+        pytest.skip("DATABASE_URL is not set")
+    await project.database.connect()
+    yield project.database.db_client
+    await project.database.disconnect()
+
+
+@pytest.fixture
+async def replica(database):
+    if project.database.read_db_client is None:
+        pytest.skip("READ_DATABASE_URL is not set")
+    project.database._recent_writes.clear()
+    yield project.database.read_db_client
+    project.database._recent_writes.clear()
@@ -0,0 +1,143 @@
+import uuid
+
+import httpx
+import prisma.models
+import project.create_invoice_service
+import project.get_invoice_service
+import project.invoice_number_service
+import project.search_invoices_service
+import project.server
+import project.tax_engine
+import pytest
+from project.create_invoice_service import (
+    InvalidInvoiceError,
+    PartDetail,
+    ServiceDetail,
+)
+
+
+@pytest.fixture
+async def catalog(database, monkeypatch):
+    monkeypatch.setattr(project.tax_engine, "_tax_table", None)
+    monkeypatch.setattr(
+        project.search_invoices_service,
+        "search_index",
+        project.search_invoices_service.InvoiceSearchIndex(),
+    )
+    project.get_invoice_service._cache.clear()
+    user = await prisma.models.User.prisma().create(
+        data={"email": f"issuer-{uuid.uuid4()}@example.com", "password": "hashed"}
+    )
+    service = await prisma.models.Service.prisma().create(
+        data={"name": "Software Development", "description": "Backend work"}
+    )
+    rate = await prisma.models.Rate.prisma().create(
+        data={"serviceId": service.id, "amount": 100.0, "currency": "EUR"}
+    )
+    part = await prisma.models.Part.prisma().create(
+        data={"name": "Hard Drive 2TB", "cost": 40.0, "markupPercentage": 25.0}
+    )
+    jurisdiction = f"J-{uuid.uuid4().hex}"
+    state = await prisma.models.TaxRate.prisma().create(
+        data={
+            "name": "State",
+            "percentage": 6.0,
+            "applicableTo": "BOTH",
+            "jurisdiction": jurisdiction,
+        }
+    )
+    await prisma.models.TaxRate.prisma().create(
+        data={
+            "name": "County",
+            "percentage": 1.5,
+            "applicableTo": "SERVICE",
+            "jurisdiction": jurisdiction,
+        }
+    )
+    yield user, service, rate, part, state
+    await project.invoice_number_service.invoice_numbers.release_all()
+
+
+async def gaps(user_id):
+    return await prisma.models.InvoiceNumberGap.prisma().find_many(
+        where={"tenantId": user_id}
+    )
+
+
+async def test_create_invoice_end_to_end(catalog):
+    user, service, rate, part, state = catalog
+    created = await project.create_invoice_service.create_invoice(
+        user.id,
+        [ServiceDetail(serviceId=service.id, hours=2, rateId=rate.id)],
+        [PartDetail(partId=part.id, quantity=2, cost=40.0)],
+        state.id,
+        "2024-05-01",
+    )
+    # 200 of service and 2 parts at 40 + 25% markup.
+    assert created.invoiceNumber == "INV-000001"
+    assert created.subtotal == 300.0
+    assert created.totalTax == pytest.approx(200.0 * 0.075 + 100.0 * 0.06)
+    assert created.totalAmount == pytest.approx(321.0)
+    assert {item.name for item in created.taxBreakdown} == {"State", "County"}
+
+    invoice = await prisma.models.Invoice.prisma().find_unique(
+        where={"id": created.invoiceId}, include={"BillableItems": True}
+    )
+    assert invoice.currency == "EUR"
+    assert invoice.invoiceNumber == 1
+    lines = {item.partId is None: item for item in invoice.BillableItems}
+    assert lines[True].rateId == rate.id and lines[True].amount == 200.0
+    assert lines[False].serviceId is None and lines[False].rateId is None
+    assert lines[False].unitPrice == 50.0
+    assert await gaps(user.id) == []
+
+    transport = httpx.ASGITransport(app=project.server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get(f"/invoice/{created.invoiceId}")
+    assert response.status_code == 200
+    detail = response.json()
+    assert detail["invoiceNumber"] == "INV-000001"
+    assert detail["totalTax"] == pytest.approx(created.totalTax)
+    assert {item["description"] for item in detail["lineItems"]} == {
+        "Software Development Backend work",
+        "Hard Drive 2TB",
+    }
+
+    response = await project.search_invoices_service.search_invoices(
+        "hard drive", 1, 20
+    )
+    assert [result.invoiceId for result in response.results] == [created.invoiceId]
+
+
+async def test_parts_only_invoice_uses_default_currency(catalog):
+    user, _, _, part, _ = catalog
+    created = await project.create_invoice_service.create_invoice(
+        user.id,
+        [],
+        [PartDetail(partId=part.id, quantity=1, cost=40.0)],
+        "",
+        "2024-05-01",
+    )
+    assert created.totalTax == 0
+    invoice = await prisma.models.Invoice.prisma().find_unique(
+        where={"id": created.invoiceId}
+    )
+    assert invoice.currency == project.create_invoice_service.DEFAULT_CURRENCY
+    assert invoice.taxRateId is None
+
+
+async def test_unknown_rate_is_rejected_before_a_number_is_used(catalog):
+    user, service, _, _, state = catalog
+    with pytest.raises(InvalidInvoiceError):
+        await project.create_invoice_service.create_invoice(
+            user.id,
+            [ServiceDetail(serviceId=service.id, hours=1, rateId=str(uuid.uuid4()))],
+            [],
+            state.id,
+            "2024-05-01",
+        )
+    assert await gaps(user.id) == []
+    counter = await prisma.models.InvoiceNumberCounter.prisma().find_unique(
+        where={"tenantId": user.id}
+    )
+    assert counter is None
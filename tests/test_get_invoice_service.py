@@ -0,0 +1,179 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import httpx
+import prisma
+import prisma.models
+import project.database
+import project.get_invoice_service
+import project.initiate_payment_service
+import project.server
+import pytest
+from project.get_invoice_service import etag_matches, make_etag, serialize_invoice
+
+NOW = datetime(2024, 4, 17, 12, tzinfo=timezone.utc)
+
+
+def test_make_etag_changes_with_version():
+    etag = make_etag("inv-1", NOW)
+    assert etag.startswith('"') and etag.endswith('"')
+    assert etag == make_etag("inv-1", NOW)
+    assert etag != make_etag("inv-1", NOW + timedelta(milliseconds=1))
+    assert etag != make_etag("inv-2", NOW)
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        (None, False),
+        ("", False),
+        ('"other"', False),
+        ("{etag}", True),
+        ("W/{etag}", True),
+        ('"other", {etag}', True),
+        ("*", True),
+    ],
+)
+def test_etag_matches(header, expected):
+    etag = make_etag("inv-1", NOW)
+    assert etag_matches(header and header.format(etag=etag), etag) is expected
+
+
+def test_serialize_invoice_uses_only_invoice_owned_rows():
+    invoice = SimpleNamespace(
+        id="inv-1",
+        invoiceNumber=42,
+        userId="user-1",
+        status="SENT",
+        currency="USD",
+        subtotal=100.0,
+        totalTax=7.5,
+        totalAmount=107.5,
+        dueDate=None,
+        createdAt=NOW,
+        updatedAt=NOW,
+        taxRateId="reduced",
+        taxBreakdown=[
+            {
+                "taxRateId": "reduced",
+                "name": "Reduced",
+                "percentage": 7.5,
+                "applicableTo": "BOTH",
+                "taxableAmount": 100.0,
+                "taxAmount": 7.5,
+            }
+        ],
+        BillableItems=[
+            SimpleNamespace(
+                id="item-1",
+                serviceId="service-1",
+                rateId="rate-1",
+                partId="",
+                description="Software Development",
+                quantity=2.0,
+                unitPrice=50.0,
+                amount=100.0,
+            )
+        ],
+        Payments=[],
+    )
+    detail = project.get_invoice_service.InvoiceDetail.model_validate_json(
+        serialize_invoice(invoice)
+    )
+    assert detail.invoiceNumber == "INV-000042"
+    assert detail.taxBreakdown[0].taxAmount == 7.5
+    assert detail.lineItems[0].description == "Software Development"
+    assert detail.lineItems[0].partId is None
+
+
+@pytest.fixture
+async def client(database):
+    project.get_invoice_service._cache.clear()
+    transport = httpx.ASGITransport(app=project.server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        yield client
+
+
+async def create_invoice():
+    user = await prisma.models.User.prisma().create(
+        data={"email": f"customer-{uuid.uuid4()}@example.com", "password": "hashed"}
+    )
+    service = await prisma.models.Service.prisma().create(
+        data={"name": "Software Development"}
+    )
+    rate = await prisma.models.Rate.prisma().create(
+        data={"serviceId": service.id, "amount": 50.0, "currency": "USD"}
+    )
+    invoice = await prisma.models.Invoice.prisma().create(
+        data={
+            "userId": user.id,
+            "totalAmount": 100.0,
+            "subtotal": 100.0,
+            "totalTax": 0.0,
+            "taxBreakdown": prisma.Json([]),
+            "currency": "USD",
+            "status": "DRAFT",
+            "BillableItems": {
+                "create": [
+                    {
+                        "serviceId": service.id,
+                        "rateId": rate.id,
+                        "description": "Software Development",
+                        "quantity": 2.0,
+                        "unitPrice": 50.0,
+                        "amount": 100.0,
+                    }
+                ]
+            },
+        }
+    )
+    return user, rate, invoice
+
+
+async def test_get_invoice_answers_conditional_requests(client):
+    user, rate, invoice = await create_invoice()
+    response = await client.get(f"/invoice/{invoice.id}")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert response.json()["lineItems"][0]["unitPrice"] == 50.0
+
+    response = await client.get(
+        f"/invoice/{invoice.id}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+    # A catalog price change does not alter the issued invoice, so its ETag holds.
+    await prisma.models.Rate.prisma().update(
+        where={"id": rate.id}, data={"amount": 80.0}
+    )
+    response = await client.get(
+        f"/invoice/{invoice.id}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+
+    await project.initiate_payment_service.initiate_payment(
+        invoice.id, user.id, "card", 100.0, "USD"
+    )
+    response = await client.get(
+        f"/invoice/{invoice.id}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert len(response.json()["payments"]) == 1
+
+
+async def test_get_invoice_returns_404_for_unknown_invoice(client):
+    response = await client.get(f"/invoice/{uuid.uuid4()}")
+    assert response.status_code == 404
+    assert response.json() == {"error": "Invoice not found"}
+
+
+async def test_get_invoice_falls_back_to_primary_on_replica_miss(replica, client):
+    # The test databases do not replicate, so the invoice only exists on the primary.
+    _, _, invoice = await create_invoice()
+    project.database._recent_writes.clear()
+    response = await client.get(f"/invoice/{invoice.id}")
+    assert response.status_code == 200
+    assert response.json()["id"] == invoice.id
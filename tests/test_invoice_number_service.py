@@ -0,0 +1,141 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import prisma.models
+import project.invoice_number_service
+import pytest
+from project.invoice_number_service import (
+    InvoiceNumberAllocator,
+    format_invoice_number,
+    missing_ranges,
+    next_block_size,
+)
+
+
+def test_format_invoice_number():
+    assert format_invoice_number(42) == "INV-000042"
+
+
+def test_missing_ranges():
+    assert missing_ranges(1, 10, [3, 4, 7]) == [(1, 3), (5, 7), (8, 10)]
+    assert missing_ranges(1, 4, [1, 2, 3]) == []
+    assert missing_ranges(1, 4, []) == [(1, 4)]
+
+
+@pytest.mark.parametrize(
+    "size, elapsed, expected",
+    [
+        (1, 0.1, 2),
+        (64, 1.0, 100),
+        (100, 0.1, 100),
+        (8, 10.0, 8),
+        (8, 60.0, 4),
+        (1, 600.0, 1),
+    ],
+)
+def test_next_block_size(size, elapsed, expected):
+    assert next_block_size(size, elapsed, target=10, maximum=100) == expected
+
+
+async def issued_and_audited(tenant_id):
+    counter = await prisma.models.InvoiceNumberCounter.prisma().find_unique(
+        where={"tenantId": tenant_id}
+    )
+    gaps = await prisma.models.InvoiceNumberGap.prisma().find_many(
+        where={"tenantId": tenant_id}
+    )
+    blocks = await prisma.models.InvoiceNumberBlock.prisma().find_many(
+        where={"tenantId": tenant_id}
+    )
+    return (
+        counter,
+        [number for gap in gaps for number in range(gap.start, gap.end)],
+        blocks,
+    )
+
+
+async def test_concurrent_workers_issue_unique_numbers(database):
+    """
+    Several workers issuing numbers for the same tenants at a high rate never hand out
+    a duplicate, lease a block only every so often, and account for every number up to
+    the counter as either issued or audited as a gap.
+    """
+    tenants = [f"tenant-{uuid.uuid4()}" for _ in range(2)]
+    workers = [InvoiceNumberAllocator(max_block_size=100) for _ in range(4)]
+    per_worker = 500
+
+    async def issue(worker, tenant_id):
+        return [await worker.next_number(tenant_id) for _ in range(per_worker)]
+
+    results = await asyncio.gather(
+        *(issue(worker, tenant_id) for worker in workers for tenant_id in tenants)
+    )
+    await asyncio.gather(*(worker.release_all() for worker in workers))
+
+    total_issued = 0
+    total_blocks = 0
+    for position, tenant_id in enumerate(tenants):
+        issued = [
+            number for result in results[position :: len(tenants)] for number in result
+        ]
+        assert len(issued) == len(set(issued)) == per_worker * len(workers)
+        counter, gaps, blocks = await issued_and_audited(tenant_id)
+        assert not set(issued) & set(gaps)
+        assert sorted(issued + gaps) == list(range(1, counter.nextValue))
+        assert all(block.releasedAt is not None for block in blocks)
+        total_issued += len(issued)
+        total_blocks += len(blocks)
+    # The counter rows are the only point of contention; they are touched once per
+    # block, not once per number.
+    assert total_blocks * 20 < total_issued
+
+
+async def test_quiet_tenant_gets_single_number_blocks_back(database):
+    tenant_id = f"tenant-{uuid.uuid4()}"
+    worker = InvoiceNumberAllocator()
+    assert await worker.next_number(tenant_id) == 1
+    await worker.release_all()
+    counter, gaps, blocks = await issued_and_audited(tenant_id)
+    assert counter.nextValue == 2
+    assert gaps == []
+    assert [(block.start, block.end) for block in blocks] == [(1, 2)]
+
+
+async def test_released_tail_returns_to_counter_when_no_one_leased_since(database):
+    tenant_id = f"tenant-{uuid.uuid4()}"
+    worker = InvoiceNumberAllocator(block_target_seconds=3600)
+    numbers = [await worker.next_number(tenant_id) for _ in range(4)]
+    assert numbers == [1, 2, 3, 4]
+    # Blocks of 1, 2 and 4 numbers: the last one still has 3 unused numbers.
+    await worker.release_all()
+    counter, gaps, _ = await issued_and_audited(tenant_id)
+    assert counter.nextValue == 5
+    assert gaps == []
+
+
+async def test_blocks_of_crashed_workers_are_reconciled(database):
+    tenant_id = f"tenant-{uuid.uuid4()}"
+    crashed = InvoiceNumberAllocator(block_target_seconds=3600)
+    # Blocks of 1 and 2 numbers; the second one still holds number 3.
+    assert [await crashed.next_number(tenant_id) for _ in range(2)] == [1, 2]
+    alive = InvoiceNumberAllocator()
+    assert await alive.next_number(tenant_id) == 4
+
+    stale = datetime.now(timezone.utc) - timedelta(hours=1)
+    await prisma.models.InvoiceNumberBlock.prisma().update_many(
+        where={"leasedBy": crashed.worker_id}, data={"heartbeatAt": stale}
+    )
+    await alive.heartbeat()
+    assert await project.invoice_number_service.reconcile_abandoned_blocks(60) >= 1
+    _, gaps, blocks = await issued_and_audited(tenant_id)
+    # No invoice was inserted for number 2, so it is a gap along with the unused 3.
+    assert sorted(gaps) == [2, 3]
+    assert {block.leasedBy for block in blocks if block.releasedAt is None} == {
+        alive.worker_id
+    }
+
+    # The crashed worker comes back: it notices its block is gone and leases anew.
+    assert await crashed.heartbeat() == 0
+    assert await crashed.next_number(tenant_id) == 5
+    await asyncio.gather(crashed.release_all(), alive.release_all())
@@ -0,0 +1,304 @@
+import asyncio
+import json
+import uuid
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import httpx
+import prisma.enums
+import prisma.models
+import project.initiate_payment_service
+import project.payment_webhook_service
+import project.replay_payment_webhooks
+import project.server
+import pytest
+from project.payment_webhook_service import (
+    InvalidSignatureError,
+    InvalidWebhookPayloadError,
+)
+
+SECRET = "test-secret"
+
+NOW = datetime(2024, 4, 17, 12, tzinfo=timezone.utc)
+
+
+@pytest.fixture(autouse=True)
+def webhook_secret(monkeypatch):
+    monkeypatch.setattr(project.payment_webhook_service, "WEBHOOK_SECRET", SECRET)
+
+
+def gateway_body(transaction_id, status, created_at, amount=None, event_id=None):
+    return json.dumps(
+        {
+            "id": event_id or f"evt_{uuid.uuid4().hex}",
+            "transaction_id": transaction_id,
+            "status": status,
+            "amount": amount,
+            "created_at": created_at.isoformat(),
+        }
+    ).encode()
+
+
+def signed_headers(body):
+    signature = project.payment_webhook_service.sign_payload(body, SECRET)
+    return {"X-Signature": f"sha256={signature}"}
+
+
+@pytest.fixture
+async def gateway():
+    """
+    A fake payment gateway: an HTTP client that posts signed deliveries to the app.
+    """
+    transport = httpx.ASGITransport(app=project.server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        yield client
+
+
+def queued(transaction_id, status, occurred_at):
+    return SimpleNamespace(
+        transactionId=transaction_id, status=status, occurredAt=occurred_at
+    )
+
+
+def test_verify_signature_accepts_both_header_forms():
+    body = b'{"id": "evt_1"}'
+    signature = project.payment_webhook_service.sign_payload(body, SECRET)
+    project.payment_webhook_service.verify_signature(body, signature)
+    project.payment_webhook_service.verify_signature(body, f"sha256={signature}")
+
+
+@pytest.mark.parametrize("signature", [None, "", "sha256=00", "deadbeef"])
+def test_verify_signature_rejects_bad_signatures(signature):
+    with pytest.raises(InvalidSignatureError):
+        project.payment_webhook_service.verify_signature(b"{}", signature)
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b"not json",
+        b"{}",
+        b'{"id": "evt_1", "transaction_id": "tx_1", "status": "paid"}',
+        gateway_body("tx_1", "refunded", NOW),
+    ],
+)
+def test_parse_event_rejects_invalid_bodies(body):
+    with pytest.raises(InvalidWebhookPayloadError):
+        project.payment_webhook_service.parse_event(body)
+
+
+def test_parse_event_assumes_utc_for_naive_timestamps():
+    event = project.payment_webhook_service.parse_event(
+        gateway_body("tx_1", "Succeeded", NOW.replace(tzinfo=None))
+    )
+    assert event.created_at == NOW
+
+
+def test_coalesce_events_keeps_latest_event_per_transaction():
+    completed = queued("tx_1", prisma.enums.PaymentStatus.COMPLETED, NOW)
+    events = [
+        queued("tx_1", prisma.enums.PaymentStatus.PENDING, NOW - timedelta(minutes=1)),
+        completed,
+        queued("tx_1", prisma.enums.PaymentStatus.PENDING, NOW),
+        queued("tx_2", prisma.enums.PaymentStatus.FAILED, NOW),
+    ]
+    latest = project.payment_webhook_service.coalesce_events(events)
+    assert latest["tx_1"] is completed
+    assert latest["tx_2"].status == prisma.enums.PaymentStatus.FAILED
+
+
+async def test_webhook_rejects_malformed_body_with_400(gateway):
+    body = b'{"id": "evt_1"'
+    response = await gateway.post(
+        "/payment/webhook", content=body, headers=signed_headers(body)
+    )
+    assert response.status_code == 400
+    assert "error" in response.json()
+
+
+async def test_webhook_rejects_bad_signature_with_401(gateway):
+    body = gateway_body("tx_1", "succeeded", NOW)
+    response = await gateway.post(
+        "/payment/webhook", content=body, headers={"X-Signature": "deadbeef"}
+    )
+    assert response.status_code == 401
+
+
+async def create_invoice(total_amount):
+    user = await prisma.models.User.prisma().create(
+        data={"email": f"payer-{uuid.uuid4()}@example.com", "password": "hashed"}
+    )
+    invoice = await prisma.models.Invoice.prisma().create(
+        data={
+            "userId": user.id,
+            "totalAmount": total_amount,
+            "currency": "USD",
+            "status": "SENT",
+        }
+    )
+    return user, invoice
+
+
+async def pay(user, invoice, amount):
+    payment = await project.initiate_payment_service.initiate_payment(
+        invoice.id, user.id, "card", amount, "USD"
+    )
+    return payment.transaction_id
+
+
+async def drain(*consumer_ids):
+    while True:
+        processed = await asyncio.gather(
+            *(
+                project.payment_webhook_service.process_pending_events(50, consumer_id)
+                for consumer_id in consumer_ids
+            )
+        )
+        if not any(processed):
+            return
+
+
+async def test_consumers_claim_disjoint_batches(database):
+    user, invoice = await create_invoice(100.0)
+    transaction_id = await pay(user, invoice, 100.0)
+    await project.payment_webhook_service.enqueue_events(
+        [
+            project.payment_webhook_service.parse_event(
+                gateway_body(transaction_id, "processing", NOW + timedelta(seconds=i))
+            )
+            for i in range(20)
+        ]
+    )
+    first, second = await asyncio.gather(
+        project.payment_webhook_service.claim_events(10, "consumer-a"),
+        project.payment_webhook_service.claim_events(10, "consumer-b"),
+    )
+    assert not {event.id for event in first} & {event.id for event in second}
+    assert {event.claimedBy for event in first} <= {"consumer-a"}
+    assert {event.claimedBy for event in second} <= {"consumer-b"}
+
+
+async def test_partial_payment_leaves_invoice_open(database, gateway):
+    user, invoice = await create_invoice(100.0)
+    first = await pay(user, invoice, 100.0)
+    body = gateway_body(first, "succeeded", NOW, amount=40.0)
+    await gateway.post("/payment/webhook", content=body, headers=signed_headers(body))
+    await drain("consumer-a")
+
+    payment = await prisma.models.Payment.prisma().find_unique(
+        where={"transactionId": first}
+    )
+    assert payment.status == prisma.enums.PaymentStatus.COMPLETED
+    assert payment.amount == 40.0
+    invoice = await prisma.models.Invoice.prisma().find_unique(where={"id": invoice.id})
+    assert invoice.status == prisma.enums.InvoiceStatus.SENT
+
+    second = await pay(user, invoice, 60.0)
+    body = gateway_body(second, "succeeded", NOW, amount=60.0)
+    await gateway.post("/payment/webhook", content=body, headers=signed_headers(body))
+    await drain("consumer-a")
+
+    invoice = await prisma.models.Invoice.prisma().find_unique(where={"id": invoice.id})
+    assert invoice.status == prisma.enums.InvoiceStatus.PAID
+
+
+async def test_final_status_is_not_demoted_at_the_same_timestamp(database, gateway):
+    user, invoice = await create_invoice(100.0)
+    transaction_id = await pay(user, invoice, 100.0)
+    for status in ("succeeded", "pending"):
+        body = gateway_body(transaction_id, status, NOW, amount=100.0)
+        await gateway.post(
+            "/payment/webhook", content=body, headers=signed_headers(body)
+        )
+        await drain("consumer-a")
+    payment = await prisma.models.Payment.prisma().find_unique(
+        where={"transactionId": transaction_id}
+    )
+    assert payment.status == prisma.enums.PaymentStatus.COMPLETED
+
+
+async def test_replay_reapplies_already_processed_events(database, gateway):
+    user, invoice = await create_invoice(100.0)
+    transaction_id = await pay(user, invoice, 100.0)
+    replay_from = datetime.now(timezone.utc) - timedelta(minutes=1)
+    body = gateway_body(transaction_id, "succeeded", NOW, amount=100.0)
+    await gateway.post("/payment/webhook", content=body, headers=signed_headers(body))
+    await drain("consumer-a")
+    # A faulty consumer got the payment wrong after the event was applied.
+    await prisma.models.Payment.prisma().update(
+        where={"transactionId": transaction_id},
+        data={"status": prisma.enums.PaymentStatus.FAILED, "amount": 0.0},
+    )
+
+    assert await project.replay_payment_webhooks.requeue_events(replay_from, None) >= 1
+    await drain("consumer-a")
+    payment = await prisma.models.Payment.prisma().find_unique(
+        where={"transactionId": transaction_id}
+    )
+    assert payment.status == prisma.enums.PaymentStatus.COMPLETED
+    assert payment.amount == 100.0
+
+
+async def test_events_for_unknown_transactions_are_logged(database, caplog):
+    transaction_id = f"tx_{uuid.uuid4().hex}"
+    await project.payment_webhook_service.enqueue_events(
+        [
+            project.payment_webhook_service.parse_event(
+                gateway_body(transaction_id, "succeeded", NOW)
+            )
+        ]
+    )
+    await drain("consumer-a")
+    assert transaction_id in caplog.text
+    event = await prisma.models.PaymentWebhookEvent.prisma().find_first(
+        where={"transactionId": transaction_id}
+    )
+    assert event.processedAt is not None
+
+
+async def test_fake_gateway_burst_is_applied_exactly_once(database, gateway):
+    """
+    A burst of deliveries, with redeliveries and out-of-order final statuses, is applied
+    exactly once by several concurrent consumers.
+    """
+    invoices = []
+    for _ in range(25):
+        user, invoice = await create_invoice(50.0)
+        invoices.append((invoice, await pay(user, invoice, 50.0)))
+    bodies = []
+    for invoice, transaction_id in invoices:
+        completed = gateway_body(
+            transaction_id, "succeeded", NOW + timedelta(seconds=2), amount=50.0
+        )
+        bodies += [
+            completed,
+            gateway_body(transaction_id, "processing", NOW + timedelta(seconds=1)),
+            gateway_body(transaction_id, "pending", NOW),
+            completed,
+        ]
+
+    responses = await asyncio.gather(
+        *(
+            gateway.post("/payment/webhook", content=body, headers=signed_headers(body))
+            for body in bodies
+        )
+    )
+    assert {response.status_code for response in responses} == {202}
+    await asyncio.wait_for(drain("consumer-a", "consumer-b", "consumer-c"), 60)
+
+    transaction_ids = [transaction_id for _, transaction_id in invoices]
+    payments = await prisma.models.Payment.prisma().find_many(
+        where={"transactionId": {"in": transaction_ids}}
+    )
+    assert {payment.status for payment in payments} == {
+        prisma.enums.PaymentStatus.COMPLETED
+    }
+    paid = await prisma.models.Invoice.prisma().find_many(
+        where={"id": {"in": [invoice.id for invoice, _ in invoices]}}
+    )
+    assert {invoice.status for invoice in paid} == {prisma.enums.InvoiceStatus.PAID}
+    events = await prisma.models.PaymentWebhookEvent.prisma().find_many(
+        where={"transactionId": {"in": transaction_ids}}
+    )
+    assert len(events) == 3 * len(invoices)
+    assert all(event.processedAt is not None for event in events)
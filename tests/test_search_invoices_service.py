@@ -0,0 +1,212 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import prisma.models
+import project.search_invoices_service
+import project.server
+import pytest
+from project.search_invoices_service import (
+    InvoiceSearchIndex,
+    QueryTooBroadError,
+    tokenize,
+)
+
+NOW = datetime(2024, 4, 17, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def index():
+    index = InvoiceSearchIndex()
+    index.index_profile("user-1", "Jane", "Doe", "Acme Corp", "12-345/6")
+    index.index_profile("user-2", "John", "Smith", "Globex", None)
+    index.index_invoice("inv-1", "user-1", NOW, ["Software Development"])
+    index.index_invoice(
+        "inv-2", "user-1", NOW + timedelta(days=1), ["Quality Assurance"]
+    )
+    index.index_invoice("inv-3", "user-2", NOW, ["Software Development"])
+    return index
+
+
+def ids(hits):
+    return [invoice_id for invoice_id, _ in hits]
+
+
+def test_tokenize_drops_punctuation():
+    assert tokenize("12-345/6 ACME") == ["12", "345", "6", "acme"]
+    assert tokenize(None) == []
+
+
+async def test_search_matches_customer_fields_on_every_invoice_of_the_user(index):
+    total, hits = await index.search("acme")
+    assert total == 2
+    assert ids(hits) == ["inv-2", "inv-1"]
+
+
+async def test_search_requires_every_term(index):
+    total, hits = await index.search("software jane")
+    assert total == 1
+    assert ids(hits) == ["inv-1"]
+
+
+async def test_search_ranks_by_field_weight(index):
+    index.index_profile("user-3", "Software", None, None, None)
+    index.index_invoice("inv-4", "user-3", NOW, [])
+    _, hits = await index.search("software")
+    assert ids(hits)[0] == "inv-4"
+
+
+async def test_search_expands_last_term_as_prefix(index):
+    total, hits = await index.search("softw")
+    assert total == 2
+    assert {score for _, score in hits} == {
+        project.search_invoices_service.LINE_ITEM_WEIGHT
+        * project.search_invoices_service.PREFIX_MATCH_FACTOR
+    }
+    assert (await index.search("jane softw"))[0] == 1
+
+
+async def test_search_expands_only_prefixes_of_minimum_length(index):
+    assert (await index.search("so"))[0] == 0
+    assert (await index.search("sof"))[0] == 2
+
+
+async def test_search_refuses_queries_matching_too_many_invoices(index, monkeypatch):
+    monkeypatch.setattr(project.search_invoices_service, "MAX_SEARCH_CANDIDATES", 1)
+    with pytest.raises(QueryTooBroadError):
+        await index.search("acme")
+    # A selective term drives the search, however common the other terms are.
+    assert (await index.search("quality acme"))[0] == 1
+    assert (await index.search("smith"))[0] == 1
+
+
+async def test_search_yields_to_other_tasks(index, monkeypatch):
+    monkeypatch.setattr(project.search_invoices_service, "SEARCH_YIELD_INTERVAL", 1)
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0)
+
+    ticker = asyncio.create_task(tick())
+    await asyncio.sleep(0)
+    started = ticks
+    total, _ = await index.search("development")
+    ticker.cancel()
+    assert total == 2
+    assert ticks > started
+
+
+async def test_search_matches_joined_tax_id(index):
+    assert ids((await index.search("123456"))[1]) == ["inv-2", "inv-1"]
+
+
+async def test_search_pages_results(index):
+    total, hits = await index.search("development", offset=1, limit=1)
+    assert total == 2
+    assert len(hits) == 1
+
+
+async def test_reindexing_profile_replaces_old_terms(index):
+    index.index_profile("user-1", "Jane", "Roe", "Initech", None)
+    assert await index.search("acme") == (0, [])
+    assert (await index.search("acm"))[0] == 0
+    assert (await index.search("initech"))[0] == 2
+    assert index.profile("user-1") == ("Jane Roe", "Initech")
+
+
+async def test_reindexing_invoice_replaces_old_terms(index):
+    index.index_invoice("inv-3", "user-1", NOW, ["Hosting"])
+    assert (await index.search("smith"))[0] == 0
+    assert ids((await index.search("hosting acme"))[1]) == ["inv-3"]
+    assert index.owner("inv-3") == "user-1"
+    assert len(index) == 3
+
+
+def test_invoices_with_same_line_items_share_terms(index):
+    assert index._doc_terms[0] is index._doc_terms[2]
+
+
+async def test_refresh_indexes_rows_written_by_other_instances(database, monkeypatch):
+    monkeypatch.setattr(
+        project.search_invoices_service, "search_index", InvoiceSearchIndex()
+    )
+    monkeypatch.setattr(project.search_invoices_service, "_profiles_synced_to", None)
+    monkeypatch.setattr(project.search_invoices_service, "_invoices_synced_to", None)
+    await project.search_invoices_service.refresh_search_index()
+
+    # Written straight to the database, as another instance would.
+    company = f"Company{uuid.uuid4().hex}"
+    user = await prisma.models.User.prisma().create(
+        data={"email": f"{company}@example.com", "password": "hashed"}
+    )
+    await prisma.models.UserProfile.prisma().create(
+        data={
+            "userId": user.id,
+            "firstName": "Jane",
+            "lastName": "Doe",
+            "companyName": company,
+        }
+    )
+    service = await prisma.models.Service.prisma().create(
+        data={"name": "Renamed catalog service"}
+    )
+    rate = await prisma.models.Rate.prisma().create(
+        data={"serviceId": service.id, "amount": 100.0, "currency": "USD"}
+    )
+    invoice = await prisma.models.Invoice.prisma().create(
+        data={
+            "userId": user.id,
+            "totalAmount": 100.0,
+            "currency": "USD",
+            "status": "DRAFT",
+            "BillableItems": {
+                "create": [
+                    {
+                        "serviceId": service.id,
+                        "rateId": rate.id,
+                        "description": "Penetration testing",
+                        "quantity": 1.0,
+                        "unitPrice": 100.0,
+                        "amount": 100.0,
+                    }
+                ]
+            },
+        }
+    )
+    assert await project.search_invoices_service.refresh_search_index() >= 2
+    response = await project.search_invoices_service.search_invoices(company, 1, 20)
+    assert [result.invoiceId for result in response.results] == [invoice.id]
+    assert response.results[0].companyName == company
+    # The line item is indexed as billed, not as the catalog names it now.
+    response = await project.search_invoices_service.search_invoices(
+        f"{company} penetration", 1, 20
+    )
+    assert response.total == 1
+    response = await project.search_invoices_service.search_invoices(
+        f"{company} renamed", 1, 20
+    )
+    assert response.total == 0
+
+
+@pytest.mark.parametrize(
+    "params", ["page=0", "page_size=0", "page_size=101", "page=first"]
+)
+async def test_search_endpoint_rejects_bad_paging(params):
+    transport = httpx.ASGITransport(app=project.server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get(f"/invoices/search?q=acme&{params}")
+    assert response.status_code == 422
+
+
+async def test_search_endpoint_rejects_broad_queries_with_400(index, monkeypatch):
+    monkeypatch.setattr(project.search_invoices_service, "search_index", index)
+    monkeypatch.setattr(project.search_invoices_service, "MAX_SEARCH_CANDIDATES", 1)
+    transport = httpx.ASGITransport(app=project.server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get("/invoices/search?q=acme")
+    assert response.status_code == 400
+    assert "error" in response.json()
@@ -0,0 +1,139 @@
+import prisma.enums
+import prisma.models
+import project.database
+import project.tax_engine
+import pytest
+from project.tax_engine import GOODS, SERVICE, TaxTable, compute_taxes
+
+BOTH = prisma.enums.TaxApplicableTo.BOTH
+
+
+def tax_rate(id, percentage, applicable_to, jurisdiction=None):
+    return prisma.models.TaxRate(
+        id=id,
+        name=id,
+        percentage=percentage,
+        applicableTo=applicable_to,
+        jurisdiction=jurisdiction,
+    )
+
+
+RATES = [
+    tax_rate("reduced", 7.5, BOTH),
+    tax_rate("standard", 20.0, BOTH),
+    tax_rate("state", 6.0, BOTH, "CA-LA"),
+    tax_rate("county", 1.5, SERVICE, "CA-LA"),
+    tax_rate("goods-only", 10.0, GOODS),
+]
+
+
+def taxes(table, tax_rate_id, lines):
+    breakdown, total = compute_taxes(table, table.jurisdiction_of(tax_rate_id), lines)
+    return {item.taxRateId: item.taxAmount for item in breakdown}, total
+
+
+def test_rates_without_jurisdiction_do_not_stack():
+    table = TaxTable(RATES)
+    breakdown, total = taxes(table, "reduced", [(SERVICE, 100.0)])
+    assert breakdown == {"reduced": 7.5}
+    assert total == 7.5
+
+
+def test_rates_sharing_a_jurisdiction_stack():
+    table = TaxTable(RATES)
+    breakdown, total = taxes(table, "state", [(SERVICE, 100.0), (GOODS, 50.0)])
+    assert breakdown == {"state": 9.0, "county": 1.5}
+    assert total == pytest.approx(10.5)
+    assert taxes(table, "county", [(SERVICE, 100.0)])[1] == pytest.approx(7.5)
+
+
+def test_rates_apply_only_to_their_line_kind():
+    table = TaxTable(RATES)
+    assert taxes(table, "goods-only", [(SERVICE, 100.0), (GOODS, 30.0)]) == (
+        {"goods-only": 3.0},
+        3.0,
+    )
+
+
+def test_no_jurisdiction_means_no_tax():
+    assert compute_taxes(TaxTable(RATES), None, [(SERVICE, 100.0)]) == ([], 0)
+
+
+class FakeTaxRates:
+    """
+    Stands in for `TaxRate.prisma()`, counting full scans and single-row lookups.
+    """
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.scans = 0
+        self.lookups = 0
+
+    async def find_many(self):
+        self.scans += 1
+        return list(self.rows)
+
+    async def find_unique(self, where):
+        self.lookups += 1
+        return next((row for row in self.rows if row.id == where["id"]), None)
+
+
+@pytest.fixture
+def tax_rates(monkeypatch):
+    fake = FakeTaxRates(RATES)
+    monkeypatch.setattr(
+        prisma.models.TaxRate, "prisma", classmethod(lambda cls, client=None: fake)
+    )
+    monkeypatch.setattr(project.database, "read_db_client", None)
+    monkeypatch.setattr(project.tax_engine, "_tax_table", None)
+    monkeypatch.setattr(project.tax_engine, "_unknown_tax_rates", set())
+    return fake
+
+
+async def test_unknown_tax_rate_is_negative_cached(tax_rates):
+    for _ in range(3):
+        _, jurisdiction = await project.tax_engine.resolve_jurisdiction("bogus")
+        assert jurisdiction is None
+    assert tax_rates.scans == 1
+    assert tax_rates.lookups == 1
+
+
+async def test_new_tax_rate_is_picked_up_without_waiting_for_the_ttl(tax_rates):
+    await project.tax_engine.resolve_jurisdiction("reduced")
+    tax_rates.rows.append(tax_rate("new", 5.0, BOTH, "NEW"))
+    table, jurisdiction = await project.tax_engine.resolve_jurisdiction("new")
+    assert jurisdiction == "NEW"
+    assert table.rates_for("NEW", SERVICE)[0].percentage == 5.0
+    assert tax_rates.scans == 2
+
+
+async def test_tax_table_is_reloaded_after_the_ttl(tax_rates, monkeypatch):
+    await project.tax_engine.get_tax_table()
+    await project.tax_engine.get_tax_table()
+    assert tax_rates.scans == 1
+    monkeypatch.setattr(project.tax_engine, "TAX_TABLE_TTL", 0)
+    await project.tax_engine.get_tax_table()
+    assert tax_rates.scans == 2
+
+
+async def test_new_tax_rate_is_loaded_from_the_primary(tax_rates, monkeypatch):
+    # The replica has not caught up with the rate created on the primary.
+    primary = FakeTaxRates(RATES + [tax_rate("new", 5.0, BOTH, "NEW")])
+    replica = object()
+    monkeypatch.setattr(
+        prisma.models.TaxRate,
+        "prisma",
+        classmethod(
+            lambda cls, client=None: tax_rates if client is replica else primary
+        ),
+    )
+    monkeypatch.setattr(project.database, "read_db_client", replica)
+    monkeypatch.setattr(project.database, "_recent_writes", {})
+    await project.tax_engine.get_tax_table()
+    for _ in range(3):
+        table, jurisdiction = await project.tax_engine.resolve_jurisdiction("new")
+        assert jurisdiction == "NEW"
+        assert compute_taxes(table, jurisdiction, [(SERVICE, 100.0)])[1] == 5.0
+    assert tax_rates.scans == 1
+    assert primary.scans == 1
+    assert tax_rates.lookups == primary.lookups == 1